@@ -6,12 +6,15 @@ import os
 
 from gratka.category import get_category
 from gratka.offer import get_offer_information
+from gratka.resilience import Resilience, RetryPolicy
+from gratka.utils import set_resilience
 
 log = logging.getLogger(__file__)
 
 SCRAPE_LIMIT = os.environ.get('SCRAPE_LIMIT', None)
 
 if __name__ == '__main__':
+    set_resilience(Resilience(RetryPolicy(attempts=3)))
     input_dict = {'category_changer': 100401, 'category_root': 100382}
 
     if os.getenv('PRICE_TO'):
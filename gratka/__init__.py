@@ -4,6 +4,11 @@
 import os
 import sys
 
+if sys.version_info < (3, 3):
+    from urlparse import urlparse
+else:
+    from urllib.parse import urlparse
+
 version = '0.0.2'
 
 VERSION = tuple(map(int, version.split('.')))
@@ -20,9 +25,33 @@ if (2, 7) <= sys.version_info < (3, 7):
     if os.getenv('DEBUG'):
         logging.basicConfig(level=logging.INFO)
 
-BASE_URL = 'http://dom.gratka.pl/'
+BASE_URL = os.getenv('GRATKA_BASE_URL', 'http://dom.gratka.pl/')
+API_URL = os.getenv('GRATKA_API_URL', 'http://www.gratka.pl/')
 
-WHITELISTED_DOMAINS = [
+DEFAULT_WHITELISTED_DOMAINS = [
     'dom.gratka.pl',
     'www.dom.gratka.pl',
 ]
+WHITELISTED_DOMAINS = list(DEFAULT_WHITELISTED_DOMAINS)
+
+
+def set_base_urls(base_url=None, api_url=None):
+    """
+    Points the library at another host, e.g. the stand-in server from :mod:`gratka.stub_server`.
+    The same can be done with the GRATKA_BASE_URL and GRATKA_API_URL environment variables.
+    :param base_url: replaces BASE_URL, the address of listing and offer pages
+    :param api_url: replaces API_URL, the address of the URL mapper and the region autosuggest
+    """
+    global BASE_URL, API_URL
+    if base_url:
+        BASE_URL = base_url if base_url.endswith('/') else base_url + '/'
+    if api_url:
+        API_URL = api_url if api_url.endswith('/') else api_url + '/'
+    # rebuilt in place from the current BASE_URL, so the host of earlier URLs is not whitelisted anymore
+    hostname = urlparse(BASE_URL).hostname
+    WHITELISTED_DOMAINS[:] = DEFAULT_WHITELISTED_DOMAINS + (
+        [hostname] if hostname not in DEFAULT_WHITELISTED_DOMAINS else []
+    )
+
+
+set_base_urls()
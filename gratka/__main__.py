@@ -0,0 +1,8 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+
+from gratka.cli import main
+
+sys.exit(main())
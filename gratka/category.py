@@ -2,11 +2,13 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import re
 import sys
 
+import gratka
 from bs4 import BeautifulSoup
-from gratka import BASE_URL, WHITELISTED_DOMAINS
-from gratka.utils import get_response_for_url, get_url
+from gratka.memory import CATEGORY_PARSE, profiled, release_tree
+from gratka.utils import get_number_from_string, get_response_for_url, get_url
 
 if sys.version_info < (3, 3):
     from urlparse import urlparse
@@ -15,7 +17,15 @@ else:
 
 log = logging.getLogger(__file__)
 
+ROOMS_PATTERN = re.compile(r"(\d+)\s+pok")
+FLOOR_PATTERN = re.compile(u"(\\d+)\\s+piętro(?:\\s+z\\s+(\\d+))?|(parter)")
+CONSTRUCTION_YEAR_PATTERN = re.compile(r"(\d{4})\s+rok budowy")
+COORDINATES_PATTERN = re.compile(r"x:\s*(-?[\d.]+),\s*y:\s*(-?[\d.]+)")
+ADDRESS_PATTERN = re.compile(r"adres:\s*\[(.*?)\]", re.DOTALL)
+CURRENCIES = {u"zł": "PLN"}
 
+
+@profiled(CATEGORY_PARSE)
 def was_category_search_successful(markup):
     """
     This method checks whether the search gave any results.
@@ -24,50 +34,123 @@ def was_category_search_successful(markup):
     """
     html_parser = BeautifulSoup(markup, "html.parser")
     has_warning = bool(html_parser.find(class_="brakWynikow"))
+    release_tree(html_parser)
     return not has_warning
 
 
-def parse_category_offer(offer_markup):
+def parse_category_offer(offer_markup, listing_details=False):
     """
     A method for getting the most important data out of an offer markup.
     :param offer_markup: a requests.response.content object
+    :param listing_details: see :meth:`gratka.category.get_category`
     :rtype: dict(string, string)
     :return: see the return section of :meth:`gratka.category.get_category` for more information
     """
     html_parser = BeautifulSoup(offer_markup, "html.parser")
+    try:
+        return _parse_category_offer(html_parser, listing_details)
+    finally:
+        release_tree(html_parser)
+
+
+def _parse_category_offer(html_parser, listing_details):
     link = html_parser.find("a")
-    url = "{0}{1}".format(BASE_URL, link.attrs['href'])
+    url = "{0}{1}".format(gratka.BASE_URL, link.attrs['href'])
     offer_id = json.loads(html_parser.find('li').attrs['data-ogloszenie'].replace("'", '"'))["id_ogl"]
     offer_position = html_parser.find('li').attrs['data-pozycja']
     offer_points = html_parser.find('li').attrs['data-punkty-wyroznienia']
     if not url:
         # detail url is not present
         return {}
-    if urlparse(url).hostname not in WHITELISTED_DOMAINS:
+    if urlparse(url).hostname not in gratka.WHITELISTED_DOMAINS:
         # domain is not supported by this backend
         return {}
-    return {
+    parsed_offer = {
         'detail_url': url,
         'offer_id': offer_id,
         'offer_position': offer_position,
         'offer_points': offer_points
     }
+    if listing_details:
+        parsed_offer.update(parse_category_offer_listing_details(html_parser))
+    return parsed_offer
+
+
+def _get_text(tag):
+    return " ".join(tag.text.split()) if tag else ""
+
+
+def _get_number(text, number_type):
+    return get_number_from_string(re.sub(r"\s", "", text), number_type, None) if text else None
+
+
+def parse_category_offer_listing_details(html_parser):
+    """
+    A method for getting the offer details shown on its listing card, named like their
+    :meth:`gratka.offer.get_offer_information` counterparts.
+    :param html_parser: a BeautifulSoup object of a single offer
+    :rtype: dict
+    :return: title, offer_type, price, currency, price_period, additional_rent, surface, rooms, floor, total_floors,
+             construction_year, voivodeship, city, district, address and geographical_coordinates. Values missing
+             from the card are None or "".
+    """
+    price = html_parser.find(class_="price")
+    info = html_parser.find(class_="infoDane")
+    info_text = _get_text(info)
+    surface = [span.b for span in info.find_all("span") if span.b] if info else []
+    rooms = ROOMS_PATTERN.search(info_text)
+    floor = FLOOR_PATTERN.search(info_text)
+    construction_year = CONSTRUCTION_YEAR_PATTERN.search(info_text)
+
+    script = html_parser.find("script")
+    script_text = script.text if script else ""
+    coordinates = COORDINATES_PATTERN.search(script_text)
+    address = ADDRESS_PATTERN.search(script_text)
+    # country, voivodeship, county, city, district, street
+    address = re.findall(r"'([^']*)'", address.group(1)) if address else []
+    address += [""] * (6 - len(address))
+    currency = _get_text(price.find("span", recursive=False)) if price else ""
+
+    return {
+        'title': _get_text(html_parser.find("h2")),
+        'offer_type': _get_text(html_parser.find("em")),
+        'price': _get_number(_get_text(price.find("b", recursive=False)) if price else "", float),
+        'currency': CURRENCIES.get(currency, currency),
+        'price_period': _get_text(price.find("i", recursive=False)) if price else "",
+        'additional_rent': _get_number(_get_text(html_parser.select_one(".oplaty b")).rstrip(u"zł"), float),
+        'surface': _get_number(_get_text(surface[0]), float) if surface else None,
+        'rooms': int(rooms.group(1)) if rooms else None,
+        'floor': (0 if floor.group(3) else int(floor.group(1))) if floor else None,
+        'total_floors': int(floor.group(2)) if floor and floor.group(2) else None,
+        'construction_year': int(construction_year.group(1)) if construction_year else None,
+        'voivodeship': address[1],
+        'city': address[3],
+        'district': address[4],
+        'address': " ".join(part for part in address[3:6] if part),
+        'geographical_coordinates': (
+            (float(coordinates.group(1)), float(coordinates.group(2))) if coordinates else ("", "")
+        ),
+    }
 
 
-def parse_category_content(markup):
+@profiled(CATEGORY_PARSE)
+def parse_category_content(markup, listing_details=False):
     """
     A method for getting a list of all the offers found in the markup.
     :param markup: a requests.response.content object
+    :param listing_details: see :meth:`gratka.category.get_category`
     :rtype: list(requests.response.content)
     """
     html_parser = BeautifulSoup(markup, "html.parser")
     offers = html_parser.find_all("li", {"data-gtm": "zajawka"})
     parsed_offers = [
-        parse_category_offer(str(offer)) for offer in offers
+        parse_category_offer(str(offer), listing_details) for offer in offers
     ]
+    release_tree(html_parser)
     return parsed_offers
 
 
+@profiled(CATEGORY_PARSE)
 def get_category_number_of_pages(markup):
     """
     A method that returns the maximal page number for a given markup, used for pagination handling.
@@ -76,7 +159,9 @@ def get_category_number_of_pages(markup):
     """
     html_parser = BeautifulSoup(markup, "html.parser")
     pages = html_parser.find(lambda tag: tag.name == 'a' and tag.get('class') == ['strona'])
-    return int(pages.text) if pages else 1
+    pages_count = int(pages.text) if pages else 1
+    release_tree(html_parser)
+    return pages_count
 
 
 def get_category_number_of_pages_from_parameters(region, **filters):
@@ -89,7 +174,7 @@ def get_category_number_of_pages_from_parameters(region, **filters):
     return get_category_number_of_pages(content)
 
 
-def get_distinct_category_page(page, region, **filters):
+def get_distinct_category_page(page, region, listing_details=False, **filters):
     """A method for scraping just the distinct page of a category"""
     parsed_content = []
     url = get_url(region, page, **filters)
@@ -97,17 +182,20 @@ def get_distinct_category_page(page, region, **filters):
     if not was_category_search_successful(content):
         log.warning("Search for category wasn't successful", url)
         return []
-    parsed_content.extend(parse_category_content(content))
+    parsed_content.extend(parse_category_content(content, listing_details))
 
     return parsed_content
 
 
-def get_category(region, **filters):
+def get_category(region, listing_details=False, **filters):
     """
     :param region: a string that contains the region name. Districts, cities and voivodeships are supported.
                     The exact location is established using Gratka's API, just as it would happen when typing something
                     into the search bar. Empty string returns results for the whole country. Will be omitted if city
                     present in filters
+    :param listing_details: also return the details shown on listing cards, see
+                            :meth:`gratka.category.parse_category_offer_listing_details`, so jobs needing only those
+                            can skip :meth:`gratka.offer.get_offer_information`
     :param filters:
     :return: the following dict contains every possible filter (for apartments, houses and rooms) with descriptions of
             its values, but can be empty:
@@ -208,7 +296,7 @@ def get_category(region, **filters):
             log.warning("Search for category wasn't successful", url)
             return []
 
-        parsed_content.extend(parse_category_content(content))
+        parsed_content.extend(parse_category_content(content, listing_details))
 
         if page == 1:
             pages_count = get_category_number_of_pages(content)
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import sqlite3
+import struct
+import time
+
+log = logging.getLogger(__file__)
+
+FINGERPRINT_FIELDS = ('price', 'additional_rent', 'description', 'photo_links', 'offer_details')
+# fields whose old and new values are both reported, the others are only stored as digests
+VALUE_FIELDS = ('price', 'additional_rent')
+# offer_details entries that change every day without the offer changing
+VOLATILE_DETAILS = ('Liczba odsłon: ', 'Dodano: ', 'Aktualizacja: ')
+
+NEW = 'new'
+CHANGED = 'changed'
+REMOVED = 'removed'
+DEACTIVATED = 'deactivated'
+REACTIVATED = 'reactivated'
+
+ACTIVE = 1
+INACTIVE = 0
+GONE = -1
+
+DIGEST = struct.Struct('>I')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    offer_id TEXT PRIMARY KEY,
+    fingerprint BLOB NOT NULL,
+    field_digests BLOB NOT NULL,
+    price REAL,
+    additional_rent REAL,
+    status INTEGER NOT NULL,
+    last_run INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL
+);
+"""
+
+
+def normalize_offer(offer):
+    """
+    :param offer: a dict returned by :meth:`gratka.offer.get_offer_information`
+    :rtype: dict
+    :return: The fields the fingerprint is computed over, without values that change on their own every day
+    """
+    normalized = dict((field, offer.get(field)) for field in FINGERPRINT_FIELDS)
+    normalized['description'] = " ".join((normalized['description'] or "").split())
+    normalized['offer_details'] = dict(
+        (key, value) for key, value in (normalized['offer_details'] or {}).items() if key not in VOLATILE_DETAILS
+    )
+    return normalized
+
+
+def _serialize(value):
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')
+
+
+def get_field_digests(normalized):
+    """
+    :param normalized: a dict returned by :meth:`normalize_offer`
+    :rtype: bytes
+    :return: A 4 byte digest of every field from FINGERPRINT_FIELDS, concatenated
+    """
+    return b"".join(hashlib.sha1(_serialize(normalized[field])).digest()[:DIGEST.size] for field in FINGERPRINT_FIELDS)
+
+
+def _fingerprint(normalized):
+    return hashlib.sha1(_serialize(normalized)).digest()[:8]
+
+
+def get_offer_fingerprint(offer):
+    """
+    :param offer: a dict returned by :meth:`gratka.offer.get_offer_information`
+    :rtype: bytes
+    :return: An 8 byte fingerprint that stays the same as long as the offer content does
+    """
+    return _fingerprint(normalize_offer(offer))
+
+
+def _is_active(offer):
+    return str(offer.get('meta', {}).get('is_active', '1')) not in ('0', '', 'False')
+
+
+class ChangeFeed(object):
+    """
+    Remembers a compact fingerprint of every offer between runs and emits only what changed: new offers, changed
+    fields (with old and new values for prices), removed offers and offers deactivated or reactivated according
+    to meta.is_active.
+
+    ::
+
+        feed = ChangeFeed("changes.db")
+        for event in feed.diff(get_offer_information(url) for url in urls):
+            publish(event)
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.run_id = None
+
+    def close(self):
+        self.connection.close()
+
+    def start_run(self):
+        with self.connection:
+            self.run_id = self.connection.execute("INSERT INTO runs (started) VALUES (?)", (time.time(),)).lastrowid
+        return self.run_id
+
+    def update(self, offer):
+        """
+        Compares the offer with its stored fingerprint and stores the new one.
+        :param offer: a dict returned by :meth:`gratka.offer.get_offer_information`
+        :rtype: list(dict)
+        :return: The change events for this offer, empty if nothing changed
+        """
+        if self.run_id is None:
+            self.start_run()
+        offer_id = str(offer.get('offer_id') or (offer.get('meta', {}).get('context') or {}).get('offer_id', ''))
+        if not offer_id:
+            raise ValueError("Offer has no offer_id")
+        normalized = normalize_offer(offer)
+        fingerprint = _fingerprint(normalized)
+        field_digests = get_field_digests(normalized)
+        status = ACTIVE if _is_active(offer) else INACTIVE
+
+        row = self.connection.execute(
+            "SELECT fingerprint, field_digests, price, additional_rent, status FROM fingerprints WHERE offer_id = ?",
+            (offer_id,)
+        ).fetchone()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (offer_id, fingerprint, field_digests, normalized['price'], normalized['additional_rent'], status,
+             self.run_id)
+        )
+
+        if row is None:
+            return [{'type': NEW, 'offer_id': offer_id, 'offer': offer}]
+        old_fingerprint, old_digests, old_price, old_additional_rent, old_status = row
+        events = []
+        if status == ACTIVE and old_status != ACTIVE:
+            events.append({'type': REACTIVATED, 'offer_id': offer_id})
+        elif status == INACTIVE and old_status == ACTIVE:
+            events.append({'type': DEACTIVATED, 'offer_id': offer_id})
+        if bytes(old_fingerprint) != fingerprint:
+            old_values = {'price': old_price, 'additional_rent': old_additional_rent}
+            changes = {}
+            for index, field in enumerate(FINGERPRINT_FIELDS):
+                position = slice(index * DIGEST.size, (index + 1) * DIGEST.size)
+                if bytes(old_digests)[position] == field_digests[position]:
+                    continue
+                changes[field] = {'new': normalized[field]}
+                if field in VALUE_FIELDS:
+                    changes[field]['old'] = old_values[field]
+            events.append({'type': CHANGED, 'offer_id': offer_id, 'changes': changes})
+        return events
+
+    def finish_run(self):
+        """
+        Marks offers that were present before, but were not updated in this run as removed.
+        Call it only after a run that covered every offer, e.g. a whole category.
+        :rtype: list(dict)
+        :return: The removal events
+        """
+        removed = [offer_id for (offer_id,) in self.connection.execute(
+            "SELECT offer_id FROM fingerprints WHERE last_run < ? AND status != ?", (self.run_id, GONE)
+        )]
+        self.connection.executemany(
+            "UPDATE fingerprints SET status = ? WHERE offer_id = ?", [(GONE, offer_id) for offer_id in removed]
+        )
+        self.connection.commit()
+        self.run_id = None
+        return [{'type': REMOVED, 'offer_id': offer_id} for offer_id in removed]
+
+    def diff(self, offers, complete=True):
+        """
+        Runs :meth:`update` for every offer in one transaction.
+        :param offers: an iterable of dicts returned by :meth:`gratka.offer.get_offer_information`
+        :param complete: whether offers contain every offer, so the missing ones can be reported as removed
+        :return: a generator of change events
+        """
+        self.start_run()
+        for offer in offers:
+            for event in self.update(offer):
+                yield event
+        if complete:
+            for event in self.finish_run():
+                yield event
+        else:
+            self.connection.commit()
+            self.run_id = None
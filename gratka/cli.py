@@ -0,0 +1,417 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import csv
+import datetime as dt
+import io
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from gratka.category import get_distinct_category_page
+from gratka.compression import CompressedCache
+from gratka.dedup import OfferDeduplicator, OfferIndex
+from gratka.memo import MemoStore, warm_up
+from gratka.memory import MemoryProfiler, set_memory_profiler
+from gratka.offer import get_offer_information, set_parse_cache
+from gratka.parse_cache import ParseCache
+from gratka.planning import plan_crawl
+from gratka.proxies import STRATEGIES, ProxyPool
+from gratka.resilience import CircuitBreaker, Resilience, RetryPolicy
+from gratka.scheduling import PRIORITIES, DetailScheduler, get_priority
+from gratka.utils import (
+    REQUEST_STATS, set_memo_store, set_proxy_pool, set_rate_limit, set_resilience, set_response_cache, set_timeout
+)
+
+log = logging.getLogger(__file__)
+
+FORMATS = ('jsonl', 'csv')
+# the CSV column holding keys the header has no column for
+CSV_EXTRA_COLUMN = 'extra'
+
+
+def filter_pair(pair):
+    """Validates a single command line KEY=VALUE filter."""
+    if "=" not in pair or pair.startswith("="):
+        raise argparse.ArgumentTypeError("filter {0!r} is not in KEY=VALUE form".format(pair))
+    return pair
+
+
+def priority_names(value):
+    """Validates a comma separated list of :mod:`gratka.scheduling` priorities."""
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    for name in names:
+        if name != 'unseen' and name not in PRIORITIES:
+            raise argparse.ArgumentTypeError("unknown priority {0!r}".format(name))
+    return names
+
+
+def parse_filters(pairs):
+    """
+    This method turns command line KEY=VALUE pairs into filters for :meth:`gratka.category.get_category`.
+    Keys ending with '[]' and repeated keys become lists, numeric values become ints.
+    :param pairs: a list of 'KEY=VALUE' strings
+    :rtype: dict
+    """
+    filters = {}
+    for pair in pairs:
+        key, value = pair.split("=", 1)
+        value = int(value) if value.isdigit() else value
+        if key.endswith("[]"):
+            filters.setdefault(key, []).append(value)
+        elif key in filters:
+            filters[key] = (filters[key] if isinstance(filters[key], list) else [filters[key]]) + [value]
+        else:
+            filters[key] = value
+    return filters
+
+
+class JsonLinesWriter(object):
+    def __init__(self, output):
+        self.output = output
+
+    def write(self, record):
+        self.output.write(json.dumps(record, ensure_ascii=False, sort_keys=True, default=str) + "\n")
+        self.output.flush()
+
+    def close(self):
+        pass
+
+
+class CsvWriter(object):
+    """
+    Writes records as CSV rows as they come, nested values are JSON encoded. Columns are the keys of the first
+    record, keys of later records missing from them are written together as a JSON object in the extra column.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.writer = None
+
+    def write(self, record):
+        row = dict(
+            (key, json.dumps(value, ensure_ascii=False, default=str) if isinstance(value, (dict, list, tuple))
+             else value)
+            for key, value in record.items()
+        )
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.output, fieldnames=sorted(row) + [CSV_EXTRA_COLUMN])
+            self.writer.writeheader()
+        extra = dict((key, record[key]) for key in row if key not in self.writer.fieldnames)
+        row = dict((key, value) for key, value in row.items() if key not in extra)
+        if extra:
+            row[CSV_EXTRA_COLUMN] = json.dumps(extra, ensure_ascii=False, sort_keys=True, default=str)
+        self.writer.writerow(row)
+        self.output.flush()
+
+    def close(self):
+        pass
+
+
+WRITERS = {'jsonl': JsonLinesWriter, 'csv': CsvWriter}
+
+
+class Progress(object):
+    """Tracks crawl progress and reports throughput, cache hit rate and an ETA."""
+
+    def __init__(self, pages_total=0, details=False):
+        self.pages_total = pages_total
+        self.details = details
+        self.pages = 0
+        self.offers = 0
+        self.scheduled_offers = 0
+        self.dropped_offers = 0
+        self.errors = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def estimated_total_requests(self):
+        if not self.details:
+            return self.pages_total
+        offers_per_page = float(self.scheduled_offers - self.dropped_offers) / self.pages if self.pages else 0
+        return self.pages_total * (1 + offers_per_page)
+
+    def report(self):
+        """
+        :rtype: string
+        :return: A single line summary of the crawl so far
+        """
+        elapsed = max(time.time() - self.started, 1e-6)
+        stats = REQUEST_STATS.snapshot()
+        fetched = stats['requests'] + stats['cache_hits']
+        done = self.pages + (self.offers if self.details else 0)
+        remaining = max(self.estimated_total_requests() - done, 0)
+        eta = dt.timedelta(seconds=int(remaining * elapsed / done)) if done else "?"
+        return "pages {0}/{1} ({2:.1f}/s), offers {3} ({4:.1f}/s), {5:.1f} kB/s, cache hits {6:.0%}, " \
+               "errors {7}, ETA {8}".format(
+                   self.pages, self.pages_total, self.pages / elapsed, self.offers, self.offers / elapsed,
+                   stats['bytes'] / elapsed / 1024, float(stats['cache_hits']) / fetched if fetched else 0,
+                   self.errors, eta
+               )
+
+
+def crawl(region, filters, writer, details=False, workers=4, limit=None, progress=None, scheduler=None, plan=None,
+          listing_details=False):
+    """
+    Scrapes all the pages of a category concurrently and writes every offer as soon as it's available.
+    :param region: see :meth:`gratka.category.get_category` for reference
+    :param filters: see :meth:`gratka.category.get_category` for reference
+    :param writer: an object with a write(record) method, e.g. :class:`JsonLinesWriter`
+    :param details: write :meth:`gratka.offer.get_offer_information` results instead of category results
+    :param workers: maximal number of concurrent requests
+    :param limit: maximal number of offers to write
+    :param progress: a :class:`Progress` object
+    :param scheduler: a :class:`gratka.scheduling.DetailScheduler` deciding which offer details are fetched first
+                      and which are dropped, offer details are fetched in listing order by default
+    :param plan: a :class:`gratka.planning.CrawlPlan` of the same region and filters, so its first page is reused
+    :param listing_details: write the details shown on listing cards with category results, ignored if a plan is
+                            given, see :meth:`gratka.category.get_category`
+    :rtype: int
+    :return: number of offers written
+    """
+    progress = progress or Progress(details=details)
+    plan = plan if plan is not None else plan_crawl(region, listing_details=listing_details, **filters)
+    progress.pages_total = plan.pages_count
+    scheduler = scheduler if scheduler is not None else DetailScheduler()
+    deduplicator = OfferDeduplicator()
+
+    def limit_reached():
+        return limit is not None and progress.scheduled_offers >= limit
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        first_page = Future()
+        first_page.set_result(plan.first_page_offers)
+        page_futures = set([first_page] if plan.pages_count else [])
+        page_futures.update(
+            executor.submit(get_distinct_category_page, page, region, listing_details=plan.listing_details, **filters)
+            for page in range(2, plan.pages_count + 1)
+        )
+        pending = set(page_futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    log.warning("Request failed: {0!r}".format(e))
+                    progress.increment('errors')
+                    continue
+                if future not in page_futures:
+                    scheduler.done(result)
+                    writer.write(result)
+                    progress.increment('offers')
+                    continue
+                progress.increment('pages')
+                for offer in deduplicator.filter_offers(result):
+                    if limit_reached():
+                        break
+                    progress.increment('scheduled_offers')
+                    if details:
+                        scheduler.push(offer)
+                    else:
+                        writer.write(offer)
+                        progress.increment('offers')
+            if limit_reached():
+                # pages that did not start yet are not needed anymore
+                pending = set(future for future in pending if future not in page_futures or not future.cancel())
+            # details are taken from the scheduler only when a worker is free, so later pages can still
+            # bring offers with a higher priority
+            detail_requests = len(pending - page_futures)
+            while detail_requests < workers:
+                offer = scheduler.pop()
+                if offer is None:
+                    break
+                pending.add(executor.submit(get_offer_information, offer['detail_url'], context=offer))
+                detail_requests += 1
+    progress.increment('dropped_offers', scheduler.stats()['dropped'])
+    return progress.offers
+
+
+def _report_progress(progress, interval, stop):
+    while not stop.wait(interval):
+        sys.stderr.write(progress.report() + "\n")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="gratka", description="Scrape offers from dom.gratka.pl")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    crawl_parser = subparsers.add_parser("crawl", help="scrape every offer of a category")
+    crawl_parser.add_argument("region", nargs="?", default="",
+                              help="region name, see gratka.category.get_category; empty for the whole country")
+    crawl_parser.add_argument("-f", "--filter", dest="filters", action="append", default=[], type=filter_pair,
+                              metavar="KEY=VALUE",
+                              help="a get_category filter, e.g. category_changer=100401; can be repeated")
+    crawl_parser.add_argument("-d", "--details", action="store_true",
+                              help="scrape offer details, not only category results")
+    crawl_parser.add_argument("--listing-details", action="store_true",
+                              help="add price, surface, rooms and location shown on listing cards to category results")
+    crawl_parser.add_argument("-w", "--workers", type=int, default=4, help="concurrent requests (default: 4)")
+    crawl_parser.add_argument("-r", "--rate", type=float, default=None, help="maximal requests per second")
+    crawl_parser.add_argument("--format", choices=FORMATS, default="jsonl",
+                              help="output format, csv columns come from the first record and other keys go to "
+                                   "the {0} column (default: jsonl)".format(CSV_EXTRA_COLUMN))
+    crawl_parser.add_argument("-o", "--output", default="-", help="output file, '-' for stdout")
+    crawl_parser.add_argument("-l", "--limit", type=int, default=None, help="maximal number of offers")
+    crawl_parser.add_argument("--cache-dir", default=None, help="keep compressed response bodies in this directory")
+    crawl_parser.add_argument("--timeout", type=float, default=60,
+                              help="seconds to wait for a connection or the next data of a response (default: 60)")
+    crawl_parser.add_argument("--retries", type=int, default=2,
+                              help="retries of a failed or throttled request, with exponential backoff (default: 2)")
+    crawl_parser.add_argument("--circuit-threshold", type=int, default=0,
+                              help="failures in a row after which a host isn't requested for 30s, 0 to disable")
+    crawl_parser.add_argument("--hedge-percentile", type=float, default=None,
+                              help="send a duplicate of requests slower than this fraction of recent ones, e.g. 0.95")
+    crawl_parser.add_argument("--proxy", dest="proxies", action="append", default=[], metavar="URL",
+                              help="send requests through this proxy, 'direct' for no proxy; can be repeated")
+    crawl_parser.add_argument("--proxy-strategy", choices=STRATEGIES, default=STRATEGIES[0],
+                              help="how the next proxy is picked (default: {0})".format(STRATEGIES[0]))
+    crawl_parser.add_argument("--parse-cache-dir", default=None,
+                              help="keep offer parse results in this directory, reused for byte-identical pages; "
+                                   "results are pickled, so only trusted users may write to it")
+    crawl_parser.add_argument("--priority", type=priority_names, default=["listing"],
+                              help="comma separated order of offer detail fetches, first decides: unseen, {0} "
+                                   "(default: listing)".format(", ".join(sorted(PRIORITIES))))
+    crawl_parser.add_argument("--seen-index", default=None,
+                              help="a file of offer ids fetched by earlier runs, for the unseen priority")
+    crawl_parser.add_argument("--max-details", type=int, default=None,
+                              help="maximal number of offer detail requests, lower priority offers are dropped")
+    crawl_parser.add_argument("--time-budget", type=float, default=None,
+                              help="seconds after which no more offer details are requested")
+    crawl_parser.add_argument("--memo-db", default=None,
+                              help="remember URL mapper and autosuggest results in this SQLite database")
+    crawl_parser.add_argument("--memory-profile", action="store_true",
+                              help="trace allocations and report memory per stage and top allocation sites on stderr")
+    crawl_parser.add_argument("--progress-interval", type=float, default=5,
+                              help="seconds between progress reports on stderr, 0 to disable (default: 5)")
+
+    warm_up_parser = subparsers.add_parser("warm-up", help="resolve regions and filters into a memo database")
+    warm_up_parser.add_argument("regions", nargs="+", metavar="region",
+                                help="region names, see gratka.category.get_category")
+    warm_up_parser.add_argument("--memo-db", required=True, help="SQLite database shared with crawl --memo-db")
+    warm_up_parser.add_argument("-f", "--filter", dest="filters", action="append", default=[], type=filter_pair,
+                                metavar="KEY=VALUE",
+                                help="a get_category filter used with every region; can be repeated")
+    warm_up_parser.add_argument("--filters-file", default=None,
+                                help="a file with one JSON filters object per line, each used with every region")
+    warm_up_parser.add_argument("-w", "--workers", type=int, default=8, help="concurrent requests (default: 8)")
+    warm_up_parser.add_argument("-r", "--rate", type=float, default=None, help="maximal requests per second")
+
+    plan_parser = subparsers.add_parser("plan", help="estimate the cost of crawls, fetching only their first pages")
+    plan_parser.add_argument("regions", nargs="+", metavar="region",
+                             help="region names, see gratka.category.get_category")
+    plan_parser.add_argument("-f", "--filter", dest="filters", action="append", default=[], type=filter_pair,
+                             metavar="KEY=VALUE", help="a get_category filter used with every region; can be repeated")
+    plan_parser.add_argument("--filters-file", default=None,
+                             help="a file with one JSON filters object per line, each used with every region")
+    plan_parser.add_argument("-d", "--details", action="store_true", help="include offer detail requests")
+    plan_parser.add_argument("-w", "--workers", type=int, default=4, help="planned concurrent requests (default: 4)")
+    plan_parser.add_argument("-r", "--rate", type=float, default=None, help="planned maximal requests per second")
+    return parser
+
+
+def run_crawl(args):
+    if 'unseen' in args.priority and not args.seen_index:
+        sys.stderr.write("the unseen priority requires --seen-index\n")
+        return 2
+    filters = parse_filters(args.filters)
+    set_rate_limit(args.rate)
+    set_timeout(min(args.timeout, 10), args.timeout)
+    set_resilience(Resilience(RetryPolicy(attempts=args.retries + 1),
+                              CircuitBreaker(args.circuit_threshold) if args.circuit_threshold else None,
+                              hedge_percentile=args.hedge_percentile))
+    if args.cache_dir:
+        set_response_cache(CompressedCache(args.cache_dir))
+    if args.proxies:
+        set_proxy_pool(ProxyPool([None if proxy == 'direct' else proxy for proxy in args.proxies],
+                                 strategy=args.proxy_strategy))
+    if args.parse_cache_dir:
+        set_parse_cache(ParseCache(disk=CompressedCache(args.parse_cache_dir)))
+    if args.memo_db:
+        set_memo_store(MemoStore(args.memo_db))
+    profiler = MemoryProfiler() if args.memory_profile else None
+    if profiler is not None:
+        profiler.start()
+        set_memory_profiler(profiler)
+    seen = OfferIndex(args.seen_index) if args.seen_index else None
+    scheduler = DetailScheduler(get_priority(args.priority, seen), max_fetches=args.max_details,
+                                time_budget=args.time_budget, seen=seen)
+    output = sys.stdout if args.output == "-" else io.open(args.output, "w", encoding="utf-8", newline="")
+    writer = WRITERS[args.format](output)
+    progress = Progress(details=args.details)
+    stop = threading.Event()
+    if args.progress_interval:
+        reporter = threading.Thread(target=_report_progress, args=(progress, args.progress_interval, stop))
+        reporter.daemon = True
+        reporter.start()
+    try:
+        crawl(args.region, filters, writer, details=args.details, workers=args.workers,
+              limit=args.limit, progress=progress, scheduler=scheduler, listing_details=args.listing_details)
+    finally:
+        stop.set()
+        writer.close()
+        if seen is not None:
+            seen.close()
+        if output is not sys.stdout:
+            output.close()
+    sys.stderr.write(progress.report() + "\n")
+    if profiler is not None:
+        sys.stderr.write(profiler.format_report() + "\n")
+        set_memory_profiler(None)
+        profiler.stop()
+    return 0
+
+
+def get_filters_list(args):
+    """
+    :return: The -f filters and the --filters-file filters of a warm-up or plan command as a list of dicts
+    """
+    filters_list = [parse_filters(args.filters)] if args.filters or not args.filters_file else []
+    if args.filters_file:
+        with open(args.filters_file) as filters_file:
+            filters_list.extend(json.loads(line) for line in filters_file if line.strip())
+    return filters_list
+
+
+def run_warm_up(args):
+    filters_list = get_filters_list(args)
+    set_rate_limit(args.rate)
+    set_memo_store(MemoStore(args.memo_db))
+    results = warm_up(args.regions, filters_list, max_workers=args.workers)
+    sys.stderr.write("resolved {resolved}, failed {failed}\n".format(**results))
+    return 1 if results['failed'] else 0
+
+
+def run_plan(args):
+    set_rate_limit(args.rate)
+    totals = dict.fromkeys(['estimated_offers', 'estimated_requests', 'estimated_bytes', 'estimated_seconds'], 0)
+    for region in args.regions:
+        for filters in get_filters_list(args):
+            plan = plan_crawl(region, details=args.details, workers=args.workers, **filters).to_dict()
+            sys.stdout.write(json.dumps(plan, ensure_ascii=False) + "\n")
+            for name in totals:
+                totals[name] += plan[name]
+    sys.stderr.write("total: offers {estimated_offers}, requests {estimated_requests}, "
+                     "{estimated_bytes} bytes, {estimated_seconds:.0f} s\n".format(**totals))
+    return 0
+
+
+COMMANDS = {'crawl': run_crawl, 'warm-up': run_warm_up, 'plan': run_plan}
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    return COMMANDS[args.command](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import errno
+import logging
+import os
+import struct
+import tempfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__file__)
+
+CODEC_RAW = b'0'
+CODEC_ZLIB = b'z'
+CODEC_ZSTD = b'Z'
+
+HEADER = struct.Struct('>cI')
+
+# zlib only ever looks at the last 32KB of a preset dictionary
+ZLIB_DICTIONARY_SIZE = 32 * 1024
+ZSTD_DICTIONARY_SIZE = 112 * 1024
+
+
+def _dictionary_id(dictionary):
+    return zlib.crc32(dictionary) & 0xffffffff if dictionary else 0
+
+
+def train_dictionary(samples, size=None):
+    """
+    This method builds a shared compression dictionary out of sample bodies, e.g. listing and detail pages.
+    Gratka markup is very repetitive, so a dictionary makes even small cached pages compress well.
+    :param samples: a list of bytes objects, most likely requests.response.content
+    :param size: maximal dictionary size in bytes, defaults to the best size for the available codec
+    :rtype: bytes
+    :return: The dictionary, ready to be passed to :class:`gratka.compression.Compressor`
+    """
+    samples = [sample for sample in samples if sample]
+    if size is None:
+        size = ZSTD_DICTIONARY_SIZE if zstandard else ZLIB_DICTIONARY_SIZE
+    if zstandard and len(samples) >= 8:
+        try:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        except zstandard.ZstdError:
+            log.info("Not enough samples to train a zstd dictionary, falling back to shared lines")
+
+    # lines shared by many pages are worth the most, and both codecs favour the end of a raw dictionary
+    frequency = collections.Counter()
+    for sample in samples:
+        frequency.update(set(line.strip() for line in sample.splitlines() if len(line.strip()) > 3))
+    shared = [line for line, count in frequency.items() if count > 1 or len(samples) == 1]
+    shared.sort(key=lambda line: (frequency[line] * len(line), line), reverse=True)
+
+    chosen, total = [], 0
+    for line in shared:
+        if total + len(line) + 1 > size:
+            continue
+        chosen.append(line)
+        total += len(line) + 1
+    return b"\n".join(reversed(chosen))
+
+
+class Compressor(object):
+    """
+    Compresses and decompresses bodies with zstd (if installed) or zlib, optionally using a shared dictionary.
+    Every blob starts with a small header naming the codec and the dictionary it was compressed with, so blobs
+    written by one codec can still be read after the other one becomes available.
+    """
+
+    def __init__(self, dictionary=None, codec=None, level=None):
+        self.dictionary = dictionary or b""
+        self.dictionary_id = _dictionary_id(self.dictionary)
+        self.codec = codec or (CODEC_ZSTD if zstandard else CODEC_ZLIB)
+        if self.codec == CODEC_ZSTD and not zstandard:
+            raise ValueError("zstd compression requires the zstandard package")
+        self.level = level
+        self._zstd_dictionary = None
+        if zstandard and self.dictionary:
+            self._zstd_dictionary = zstandard.ZstdCompressionDict(self.dictionary)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path, "rb") as dictionary_file:
+            return cls(dictionary=dictionary_file.read(), **kwargs)
+
+    def save_dictionary(self, path):
+        with open(path, "wb") as dictionary_file:
+            dictionary_file.write(self.dictionary)
+
+    def compress(self, data):
+        """
+        :param data: bytes to compress
+        :rtype: bytes
+        """
+        if self.codec == CODEC_ZSTD:
+            compressor = zstandard.ZstdCompressor(level=self.level or 3, dict_data=self._zstd_dictionary)
+            payload = compressor.compress(data)
+        elif self.codec == CODEC_ZLIB:
+            level = self.level if self.level is not None else 6
+            compressor = (zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY,
+                                           self.dictionary[-ZLIB_DICTIONARY_SIZE:])
+                          if self.dictionary else zlib.compressobj(level))
+            payload = compressor.compress(data) + compressor.flush()
+        else:
+            payload = data
+        dictionary_id = self.dictionary_id if self.codec != CODEC_RAW else 0
+        return HEADER.pack(self.codec, dictionary_id) + payload
+
+    def decompress(self, blob):
+        """
+        :param blob: bytes returned by :meth:`compress`
+        :rtype: bytes
+        """
+        codec, dictionary_id = HEADER.unpack(blob[:HEADER.size])
+        payload = blob[HEADER.size:]
+        if dictionary_id and dictionary_id != self.dictionary_id:
+            raise ValueError("Blob was compressed with a different dictionary")
+        if codec == CODEC_ZSTD:
+            if not zstandard:
+                raise ValueError("zstd decompression requires the zstandard package")
+            decompressor = zstandard.ZstdDecompressor(dict_data=self._zstd_dictionary if dictionary_id else None)
+            return decompressor.stream_reader(payload).read()
+        if codec == CODEC_ZLIB:
+            decompressor = (zlib.decompressobj(zlib.MAX_WBITS, self.dictionary[-ZLIB_DICTIONARY_SIZE:])
+                            if dictionary_id else zlib.decompressobj())
+            return decompressor.decompress(payload) + decompressor.flush()
+        if codec == CODEC_RAW:
+            return payload
+        raise ValueError("Unknown codec {0!r}".format(codec))
+
+
+class CompressedCache(object):
+    """
+    A directory of compressed bodies, one file per key. Used for cached and archived responses.
+    """
+
+    def __init__(self, directory, compressor=None):
+        self.directory = directory
+        self.compressor = compressor or Compressor()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def keys(self):
+        return [name for name in os.listdir(self.directory) if not name.startswith(".")]
+
+    def get(self, key):
+        """
+        :param key: cache key, a valid file name
+        :rtype: bytes or None
+        """
+        try:
+            with open(self._path(key), "rb") as cache_file:
+                blob = cache_file.read()
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return self.compressor.decompress(blob)
+
+    def set(self, key, data):
+        """
+        Stores the data atomically, so concurrent readers never see a partially written file.
+        :param key: cache key, a valid file name
+        :param data: bytes to store
+        """
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        with os.fdopen(descriptor, "wb") as cache_file:
+            cache_file.write(self.compressor.compress(data))
+        os.rename(temporary_path, self._path(key))
@@ -0,0 +1,327 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+
+from gratka.category import get_category_number_of_pages_from_parameters, get_distinct_category_page
+from gratka.offer import get_offer_information
+
+log = logging.getLogger(__file__)
+
+TASK_PAGE = 'page'
+TASK_DETAIL = 'detail'
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_by_status ON tasks (status, shard, available_at);
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+"""
+
+Task = collections.namedtuple('Task', ['id', 'kind', 'key', 'payload', 'shard', 'attempts', 'lease_owner'])
+
+
+def get_worker_id():
+    """
+    :rtype: string
+    :return: An identifier unique for this process on this node
+    """
+    return "{0}-{1}-{2}".format(socket.gethostname(), os.getpid(), threading.current_thread().ident)
+
+
+class CrawlQueue(object):
+    """
+    A work queue of category page and offer detail tasks kept in a SQLite database, so that any number of worker
+    processes sharing the database file can drain it and a crashed worker loses at most its leased tasks.
+
+    Tasks are leased for lease_seconds. A lease that is neither acknowledged nor failed before it expires is handed
+    out again, up to max_attempts times in total.
+    """
+
+    def __init__(self, path, shards=1, lease_seconds=300, max_attempts=3, retry_delay=30, timeout=30):
+        self.path = path
+        self.shards = shards
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self._local = threading.local()
+        self.connection.executescript(SCHEMA)
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _transaction(self):
+        return _ImmediateTransaction(self.connection)
+
+    def get_shard(self, key):
+        return zlib.crc32(key.encode('utf-8')) % self.shards
+
+    def enqueue(self, kind, payload, key=None):
+        """
+        Adds a task, unless a task with the same key was already added.
+        :param kind: TASK_PAGE or TASK_DETAIL
+        :param payload: a JSON serializable dict
+        :param key: a string identifying the task, defaults to the serialized payload
+        :rtype: boolean
+        :return: True if the task was added
+        """
+        return self.enqueue_many(kind, [(payload, key)]) == 1
+
+    def enqueue_many(self, kind, tasks):
+        """
+        :param kind: TASK_PAGE or TASK_DETAIL
+        :param tasks: an iterable of (payload, key) tuples, see :meth:`enqueue`
+        :rtype: int
+        :return: number of tasks actually added
+        """
+        rows = []
+        for payload, key in tasks:
+            serialized = json.dumps(payload, sort_keys=True)
+            key = "{0}:{1}".format(kind, key or serialized)
+            rows.append((kind, key, serialized, self.get_shard(key)))
+        with self._transaction() as connection:
+            before = connection.total_changes
+            connection.executemany(
+                "INSERT OR IGNORE INTO tasks (kind, key, payload, shard) VALUES (?, ?, ?, ?)", rows
+            )
+            return connection.total_changes - before
+
+    def enqueue_category(self, region, **filters):
+        """
+        Turns a :meth:`gratka.category.get_category` query into one task per results page.
+        :param region: see :meth:`gratka.category.get_category` for reference
+        :param filters: see :meth:`gratka.category.get_category` for reference
+        :rtype: int
+        :return: number of page tasks added
+        """
+        pages_count = get_category_number_of_pages_from_parameters(region, **filters)
+        return self.enqueue_many(TASK_PAGE, [
+            ({'region': region, 'page': page, 'filters': filters}, None) for page in range(1, pages_count + 1)
+        ])
+
+    def lease(self, worker_id=None, limit=1, kinds=None, shards=None):
+        """
+        Leases up to limit tasks that are pending or whose previous lease expired.
+        :param worker_id: the lease owner, see :meth:`get_worker_id`
+        :param limit: maximal number of tasks to lease
+        :param kinds: a list of task kinds to lease, all kinds by default
+        :param shards: a list of shards to lease from, all shards by default
+        :rtype: list(Task)
+        """
+        worker_id = worker_id or get_worker_id()
+        now = time.time()
+        conditions, parameters = ["available_at <= ?"], [now]
+        if kinds:
+            conditions.append("kind IN ({0})".format(", ".join("?" * len(kinds))))
+            parameters.extend(kinds)
+        if shards is not None:
+            conditions.append("shard IN ({0})".format(", ".join("?" * len(shards))))
+            parameters.extend(shards)
+
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE tasks SET status = ?, error = 'lease expired' "
+                "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, LEASED, now, self.max_attempts)
+            )
+            rows = connection.execute(
+                "SELECT id, kind, key, payload, shard, attempts FROM tasks "
+                "WHERE (status = ? OR (status = ? AND lease_expires < ?)) AND {0} "
+                "ORDER BY kind = ?, id LIMIT ?".format(" AND ".join(conditions)),
+                [PENDING, LEASED, now] + parameters + [TASK_PAGE, limit]
+            ).fetchall()
+            connection.executemany(
+                "UPDATE tasks SET status = ?, attempts = attempts + 1, lease_owner = ?, lease_expires = ? "
+                "WHERE id = ?",
+                [(LEASED, worker_id, now + self.lease_seconds, row[0]) for row in rows]
+            )
+        return [
+            Task(task_id, kind, key, json.loads(payload), shard, attempts + 1, worker_id)
+            for task_id, kind, key, payload, shard, attempts in rows
+        ]
+
+    def extend(self, task):
+        """
+        Renews the lease of a long running task.
+        :rtype: boolean
+        :return: False if the lease was lost to another worker
+        """
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE tasks SET lease_expires = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+                (time.time() + self.lease_seconds, task.id, LEASED, task.lease_owner)
+            )
+            return cursor.rowcount == 1
+
+    def ack(self, task, result=None):
+        """
+        Marks the task as done and stores its result.
+        :param task: a Task returned by :meth:`lease`
+        :param result: a JSON serializable result
+        :rtype: boolean
+        :return: False if the lease was lost to another worker in the meantime
+        """
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE tasks SET status = ?, error = NULL WHERE id = ? AND status = ? AND lease_owner = ?",
+                (DONE, task.id, LEASED, task.lease_owner)
+            )
+            if cursor.rowcount != 1:
+                return False
+            if result is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO results (key, kind, payload) VALUES (?, ?, ?)",
+                    (task.key, task.kind, json.dumps(result))
+                )
+            return True
+
+    def fail(self, task, error=""):
+        """
+        Puts the task back into the queue after retry_delay, or marks it as failed once it ran out of attempts.
+        :param task: a Task returned by :meth:`lease`
+        :param error: a description of what went wrong
+        """
+        status = FAILED if task.attempts >= self.max_attempts else PENDING
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE tasks SET status = ?, error = ?, available_at = ?, lease_owner = NULL, lease_expires = NULL "
+                "WHERE id = ? AND status = ? AND lease_owner = ?",
+                (status, str(error), time.time() + self.retry_delay, task.id, LEASED, task.lease_owner)
+            )
+
+    def stats(self):
+        """
+        :rtype: dict(string, int)
+        :return: number of tasks in every status
+        """
+        counts = dict.fromkeys([PENDING, LEASED, DONE, FAILED], 0)
+        counts.update(self.connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return counts
+
+    def is_drained(self):
+        counts = self.stats()
+        return not counts[PENDING] and not counts[LEASED]
+
+    def results(self, kind=None):
+        """
+        :param kind: TASK_PAGE or TASK_DETAIL, all kinds by default
+        :return: a generator of stored task results
+        """
+        query, parameters = "SELECT payload FROM results", ()
+        if kind:
+            query, parameters = query + " WHERE kind = ?", (kind,)
+        for (payload,) in self.connection.execute(query, parameters):
+            yield json.loads(payload)
+
+
+class _ImmediateTransaction(object):
+    """Takes the database write lock up front, so two workers never lease the same task."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        return False
+
+
+def process_task(queue, task, details=True):
+    """
+    Runs a single task. Page tasks enqueue a detail task for every offer found on the page.
+    :param queue: a :class:`CrawlQueue` object
+    :param task: a Task returned by :meth:`CrawlQueue.lease`
+    :param details: whether offers found on result pages should be scraped with
+                    :meth:`gratka.offer.get_offer_information`
+    :return: the task result
+    """
+    payload = task.payload
+    if task.kind == TASK_PAGE:
+        offers = get_distinct_category_page(payload['page'], payload['region'], **payload['filters'])
+        if details:
+            queue.enqueue_many(TASK_DETAIL, [
+                ({'url': offer['detail_url'], 'context': offer}, offer['detail_url']) for offer in offers if offer
+            ])
+        return offers
+    if task.kind == TASK_DETAIL:
+        return get_offer_information(payload['url'], context=payload.get('context'))
+    raise ValueError("Unknown task kind {0}".format(task.kind))
+
+
+def run_worker(queue, worker_id=None, kinds=None, shards=None, details=True, poll_interval=1.0, exit_when_drained=True):
+    """
+    Leases and processes tasks until the queue is drained.
+    :param queue: a :class:`CrawlQueue` object
+    :param worker_id: the lease owner, see :meth:`get_worker_id`
+    :param kinds: see :meth:`CrawlQueue.lease`
+    :param shards: see :meth:`CrawlQueue.lease`
+    :param details: see :meth:`process_task`
+    :param poll_interval: seconds to wait when no task is available
+    :param exit_when_drained: return once no task is pending or leased, otherwise poll forever
+    :rtype: int
+    :return: number of tasks processed successfully
+    """
+    worker_id = worker_id or get_worker_id()
+    processed = 0
+    while True:
+        tasks = queue.lease(worker_id, kinds=kinds, shards=shards)
+        if not tasks:
+            if exit_when_drained and queue.is_drained():
+                return processed
+            time.sleep(poll_interval)
+            continue
+        task = tasks[0]
+        log.info("Processing {0} task {1}".format(task.kind, task.key))
+        try:
+            result = process_task(queue, task, details=details)
+        except Exception as e:
+            log.warning("Task {0} failed: {1!r}".format(task.key, e))
+            queue.fail(task, repr(e))
+        else:
+            if queue.ack(task, result):
+                processed += 1
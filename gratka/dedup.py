@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import math
+import os
+import struct
+import threading
+
+from gratka.offer import get_offer_information
+
+log = logging.getLogger(__file__)
+
+KEY_SIZE = 8
+
+
+def get_offer_key(offer_id):
+    """
+    :param offer_id: offer_id as returned by :meth:`gratka.category.get_category`
+    :rtype: bytes
+    :return: A fixed size hash of the offer_id
+    """
+    return hashlib.sha1(str(offer_id).encode('utf-8')).digest()[:KEY_SIZE]
+
+
+class OfferIndex(object):
+    """
+    An exact set of offer ids. With a path it's persisted as an append-only file of 8 byte hashes, so a run can be
+    resumed or shared with a later one.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._keys = set()
+        self._lock = threading.Lock()
+        self._file = None
+        if path:
+            if os.path.exists(path):
+                with open(path, "rb") as index_file:
+                    data = index_file.read()
+                whole = len(data) - len(data) % KEY_SIZE
+                self._keys.update(data[i:i + KEY_SIZE] for i in range(0, whole, KEY_SIZE))
+            self._file = open(path, "ab")
+
+    def __contains__(self, offer_id):
+        return get_offer_key(offer_id) in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, offer_id):
+        """
+        :param offer_id: offer_id as returned by :meth:`gratka.category.get_category`
+        :rtype: boolean
+        :return: True if the offer_id was not in the index before
+        """
+        key = get_offer_key(offer_id)
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys.add(key)
+            if self._file:
+                self._file.write(key)
+        return True
+
+    def flush(self):
+        if self._file:
+            with self._lock:
+                self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class BloomFilter(object):
+    """
+    A probabilistic set of offer ids for very large runs. It uses a fixed amount of memory, but reports a new offer
+    as already seen with probability error_rate.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def _positions(self, offer_id):
+        first, second = struct.unpack('>QQ', hashlib.md5(str(offer_id).encode('utf-8')).digest())
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def __contains__(self, offer_id):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(offer_id))
+
+    def __len__(self):
+        return self.count
+
+    def add(self, offer_id):
+        """
+        :param offer_id: offer_id as returned by :meth:`gratka.category.get_category`
+        :rtype: boolean
+        :return: True if the offer_id was (most likely) not in the filter before
+        """
+        positions = self._positions(offer_id)
+        with self._lock:
+            added = False
+            for position in positions:
+                mask = 1 << (position & 7)
+                if not self.bits[position >> 3] & mask:
+                    self.bits[position >> 3] |= mask
+                    added = True
+            self.count += added
+        return added
+
+
+class OfferDeduplicator(object):
+    """
+    Sits between :meth:`gratka.category.get_category` results and :meth:`gratka.offer.get_offer_information`, so that
+    offers returned by many overlapping queries are fetched only once.
+    """
+
+    def __init__(self, index=None):
+        """
+        :param index: an :class:`OfferIndex` or a :class:`BloomFilter`, an in-memory OfferIndex by default
+        """
+        self.index = index if index is not None else OfferIndex()
+        self.seen = 0
+        self.avoided = 0
+        # is_new is called from every detail fetch thread
+        self._lock = threading.Lock()
+
+    def is_new(self, offer):
+        """
+        :param offer: a dict returned by :meth:`gratka.category.get_category`
+        :rtype: boolean
+        """
+        is_new = self.index.add(offer['offer_id'])
+        with self._lock:
+            self.seen += 1
+            if not is_new:
+                self.avoided += 1
+        return is_new
+
+    def filter_offers(self, offers):
+        """
+        :param offers: an iterable of dicts returned by :meth:`gratka.category.get_category`
+        :return: a generator of offers that were not seen before
+        """
+        for offer in offers:
+            if offer and self.is_new(offer):
+                yield offer
+
+    def get_offers_information(self, offers):
+        """
+        Scrapes every offer that was not seen before.
+        :param offers: an iterable of dicts returned by :meth:`gratka.category.get_category`
+        :return: a generator of dicts returned by :meth:`gratka.offer.get_offer_information`
+        """
+        for offer in self.filter_offers(offers):
+            yield get_offer_information(offer['detail_url'], context=offer)
+
+    def stats(self):
+        """
+        :rtype: dict(string, int)
+        :return: number of offers seen, and number of detail fetches avoided
+        """
+        with self._lock:
+            return {'seen': self.seen, 'new': self.seen - self.avoided, 'avoided_fetches': self.avoided}
@@ -0,0 +1,253 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import importlib
+import logging
+import os
+import pickle
+import sys
+import time
+
+from gratka.category import parse_category_content
+from gratka.compression import CompressedCache
+from gratka.offer import parse_offer_information
+from gratka.stub_server import DEFAULT_DATA_DIR
+
+log = logging.getLogger(__file__)
+
+OFFER = 'offer'
+CATEGORY = 'category'
+KINDS = (OFFER, CATEGORY)
+# extractors whose results every faster path has to reproduce
+REFERENCES = {OFFER: parse_offer_information, CATEGORY: parse_category_content}
+
+PICKLE_MARKER = b'\x80'
+STRING_TYPES = (str, type(u""))
+
+
+class _Missing(object):
+    def __repr__(self):
+        return "<missing>"
+
+
+MISSING = _Missing()
+
+
+def get_page_kind(body):
+    """
+    :param body: a page body
+    :rtype: string or None
+    :return: CATEGORY for listing pages and cards, OFFER for offer pages, None for anything else
+    """
+    if b'data-gtm="zajawka"' in body:
+        return CATEGORY
+    if b'application/ld+json' in body and b'dataLayer' in body:
+        return OFFER
+    return None
+
+
+def load_fixtures(directory=DEFAULT_DATA_DIR):
+    """
+    :param directory: a directory of page bodies, pickled like test_data or plain
+    :rtype: list(tuple(string, bytes))
+    :return: file names and bodies
+    """
+    pages = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.startswith(".") or not os.path.isfile(path):
+            continue
+        with open(path, "rb") as page_file:
+            body = page_file.read()
+        if body.startswith(PICKLE_MARKER):
+            body = pickle.loads(body)
+        pages.append((name, body if isinstance(body, bytes) else body.encode("utf-8")))
+    return pages
+
+
+def load_archive(directory):
+    """
+    :param directory: a :class:`gratka.compression.CompressedCache` directory, e.g. a crawl --cache-dir
+    :rtype: list(tuple(string, bytes))
+    :return: cache keys and bodies
+    """
+    cache = CompressedCache(directory)
+    return [(key, cache.get(key)) for key in sorted(cache.keys())]
+
+
+def build_corpus(fixture_directories=(DEFAULT_DATA_DIR,), archive_directories=()):
+    """
+    :param fixture_directories: see :meth:`load_fixtures`
+    :param archive_directories: see :meth:`load_archive`
+    :rtype: dict(string, list(tuple(string, bytes)))
+    :return: Named pages by kind, pages of unknown kind are left out
+    """
+    corpus = dict((kind, []) for kind in KINDS)
+    pages = [page for directory in fixture_directories for page in load_fixtures(directory)]
+    pages += [page for directory in archive_directories for page in load_archive(directory)]
+    for name, body in pages:
+        kind = get_page_kind(body)
+        if kind is None:
+            log.info("Skipping {0}, neither a listing nor an offer page".format(name))
+            continue
+        corpus[kind].append((name, body))
+    return corpus
+
+
+def _join(path, key):
+    if isinstance(key, int):
+        return "{0}[{1}]".format(path, key)
+    return "{0}.{1}".format(path, key) if path else u"{0}".format(key)
+
+
+def _same_type(reference, candidate):
+    # 1 and 1.0 are written out differently, byte and unicode strings of the same text are not
+    if isinstance(reference, STRING_TYPES) and isinstance(candidate, STRING_TYPES):
+        return True
+    return type(reference) is type(candidate)
+
+
+def diff(reference, candidate, path=""):
+    """
+    :param reference: a result of the reference extractor
+    :param candidate: a result of the candidate extractor for the same page
+    :param path: path of the compared values, used in the results
+    :rtype: list(tuple(string, object, object))
+    :return: Paths like '[3].price' or 'apartment_details.Piętro' of differing values, with both values. Values
+             missing on one side are MISSING, lists and tuples of equal items are equal.
+    """
+    if isinstance(reference, dict) and isinstance(candidate, dict):
+        differences = []
+        for key in sorted(set(reference) | set(candidate), key=lambda key: u"{0}".format(key)):
+            differences.extend(diff(reference.get(key, MISSING), candidate.get(key, MISSING), _join(path, key)))
+        return differences
+    if isinstance(reference, (list, tuple)) and isinstance(candidate, (list, tuple)):
+        differences = []
+        for index in range(max(len(reference), len(candidate))):
+            differences.extend(diff(
+                reference[index] if index < len(reference) else MISSING,
+                candidate[index] if index < len(candidate) else MISSING,
+                _join(path, index)
+            ))
+        return differences
+    if reference is MISSING or candidate is MISSING or reference != candidate or not _same_type(reference, candidate):
+        return [(path, reference, candidate)]
+    return []
+
+
+class PathReport(object):
+    """The outcome of running one extraction path over a corpus."""
+
+    def __init__(self, name):
+        self.name = name
+        self.pages = 0
+        self.seconds = 0.0
+        self.reference_seconds = 0.0
+        self.differences = {}
+        self.errors = {}
+
+    @property
+    def equivalent(self):
+        return not self.differences and not self.errors
+
+    @property
+    def speedup(self):
+        """How many times faster than the reference path, None if not measured."""
+        return self.reference_seconds / self.seconds if self.seconds else None
+
+    def to_dict(self):
+        return {
+            'name': self.name, 'pages': self.pages, 'equivalent': self.equivalent,
+            'differing_pages': len(self.differences), 'errors': len(self.errors),
+            'seconds': self.seconds, 'reference_seconds': self.reference_seconds, 'speedup': self.speedup,
+        }
+
+
+def _timed(extractor, body, repeat):
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.time()
+        result = extractor(body)
+        seconds = time.time() - started
+        best = seconds if best is None else min(best, seconds)
+    return result, best
+
+
+def compare(pages, candidates, reference, repeat=1):
+    """
+    Runs the reference and every candidate on every page, one page at a time, so all paths are timed under the
+    same conditions.
+    :param pages: a list of (name, body) tuples of one kind, see :meth:`build_corpus`
+    :param candidates: a dict of names and functions taking a body, the same way reference does
+    :param reference: e.g. REFERENCES[OFFER]
+    :param repeat: runs of every path on every page, the fastest run is counted
+    :rtype: dict(string, PathReport)
+    :return: A report for every candidate
+    """
+    reports = dict((name, PathReport(name)) for name in candidates)
+    for page, body in pages:
+        expected, reference_seconds = _timed(reference, body, repeat)
+        for name, candidate in candidates.items():
+            report = reports[name]
+            report.pages += 1
+            try:
+                result, seconds = _timed(candidate, body, repeat)
+            except Exception as e:
+                report.errors[page] = repr(e)
+                continue
+            report.seconds += seconds
+            report.reference_seconds += reference_seconds
+            differences = diff(expected, result)
+            if differences:
+                report.differences[page] = differences
+    return reports
+
+
+def load_candidate(path):
+    """
+    :param path: 'package.module:function'
+    :return: the function
+    """
+    module_name, _, function_name = path.partition(":")
+    if not function_name:
+        raise ValueError("Candidate {0!r} is not in module:function form".format(path))
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that faster extractors return what the reference ones do")
+    parser.add_argument("candidates", nargs="+", metavar="module:function",
+                        help="extractors taking a page body, like the reference extractor of --kind")
+    parser.add_argument("-k", "--kind", choices=KINDS, default=OFFER,
+                        help="offer: parse_offer_information, category: parse_category_content (default: offer)")
+    parser.add_argument("--data-dir", dest="data_dirs", action="append", default=None,
+                        help="a directory of page fixtures; can be repeated (default: test_data)")
+    parser.add_argument("--archive", dest="archives", action="append", default=[],
+                        help="a compressed response cache directory, e.g. crawl --cache-dir; can be repeated")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="runs per page, the fastest counts (default: 3)")
+    parser.add_argument("--show", type=int, default=10, help="differences printed per page (default: 10)")
+    args = parser.parse_args(argv)
+    pages = build_corpus(args.data_dirs or [DEFAULT_DATA_DIR], args.archives)[args.kind]
+    if not pages:
+        sys.stderr.write("no {0} pages in the corpus\n".format(args.kind))
+        return 2
+    candidates = dict((path, load_candidate(path)) for path in args.candidates)
+    reports = compare(pages, candidates, REFERENCES[args.kind], repeat=args.repeat)
+    for path in args.candidates:
+        report = reports[path]
+        for page, error in sorted(report.errors.items()):
+            sys.stdout.write(u"{0} {1}: raised {2}\n".format(path, page, error))
+        for page, differences in sorted(report.differences.items()):
+            for field, expected, result in differences[:args.show]:
+                sys.stdout.write(u"{0} {1} {2}: {3!r} != {4!r}\n".format(path, page, field, expected, result))
+            if len(differences) > args.show:
+                sys.stdout.write(u"{0} {1}: {2} more\n".format(path, page, len(differences) - args.show))
+        sys.stdout.write("{name}: {pages} pages, {differing_pages} differing, {errors} errors, ".format(
+            **report.to_dict()
+        ) + ("{0:.2f}x the reference speed\n".format(report.speedup) if report.speedup else "not timed\n"))
+    return 0 if all(report.equivalent for report in reports.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
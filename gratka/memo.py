@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__file__)
+
+MAPPER = 'mapper'
+AUTOSUGGEST = 'autosuggest'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS memo (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+"""
+
+
+def normalize_filters(filters):
+    """
+    :param filters: see :meth:`gratka.category.get_category` for reference
+    :rtype: string
+    :return: A canonical representation of the filters, the same for equal filters in any order or type
+    """
+    return json.dumps(dict(
+        (key, sorted(str(element) for element in value) if isinstance(value, (list, tuple)) else str(value))
+        for key, value in filters.items()
+    ), sort_keys=True)
+
+
+def normalize_region(region):
+    """
+    :param region: see :meth:`gratka.category.get_category` for reference
+    :rtype: string
+    """
+    return u" ".join((region or u"").lower().split())
+
+
+class MemoStore(object):
+    """
+    A persistent key-value store for URL mapper and autosuggest results, shared by every worker process using the
+    same database file. Entries older than max_age seconds are ignored.
+    """
+
+    def __init__(self, path, max_age=None, timeout=30):
+        self.path = path
+        self.max_age = max_age
+        self.timeout = timeout
+        self._local = threading.local()
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, namespace, key, default=None):
+        """
+        :param namespace: MAPPER, AUTOSUGGEST or any other string
+        :param key: a normalized key, see :meth:`normalize_filters` and :meth:`normalize_region`
+        :return: The stored value or default
+        """
+        row = self.connection.execute(
+            "SELECT value, created FROM memo WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None or (self.max_age is not None and time.time() - row[1] > self.max_age):
+            return default
+        return json.loads(row[0])
+
+    def set(self, namespace, key, value):
+        """
+        :param namespace: MAPPER, AUTOSUGGEST or any other string
+        :param key: a normalized key, see :meth:`normalize_filters` and :meth:`normalize_region`
+        :param value: a JSON serializable value
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO memo (namespace, key, value, created) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), time.time())
+            )
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM memo").fetchone()[0]
+
+
+def warm_up(regions, filters_list, max_workers=8):
+    """
+    Resolves every region and filters combination with :meth:`gratka.utils.get_url` concurrently, so that the
+    autosuggest and URL mapper results are in the memo store before a crawl starts.
+    Use :meth:`gratka.utils.set_memo_store` first.
+    :param regions: a list of region strings, see :meth:`gratka.category.get_category` for reference
+    :param filters_list: a list of filter dicts, see :meth:`gratka.category.get_category` for reference
+    :param max_workers: number of concurrent requests
+    :rtype: dict(string, int)
+    :return: number of combinations resolved and failed
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from gratka.utils import get_url
+
+    def resolve(combination):
+        region, filters = combination
+        try:
+            get_url(region, 1, **filters)
+            return True
+        except Exception as e:
+            log.warning("Could not resolve {0!r} {1!r}: {2!r}".format(region, filters, e))
+            return False
+
+    combinations = [(region, filters) for region in regions for filters in filters_list]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(resolve, combinations))
+    return {'resolved': results.count(True), 'failed': results.count(False)}
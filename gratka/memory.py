@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import functools
+import logging
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+log = logging.getLogger(__file__)
+
+FETCH = 'fetch'
+CATEGORY_PARSE = 'category_parse'
+OFFER_PARSE = 'offer_parse'
+CACHE = 'cache'
+STAGES = (FETCH, CATEGORY_PARSE, OFFER_PARSE, CACHE)
+
+PROFILER = None
+
+
+def set_memory_profiler(profiler):
+    """
+    Makes the fetch, parse and cache stages report their allocations to the given profiler.
+    :param profiler: a started :class:`MemoryProfiler` or None to stop profiling
+    """
+    global PROFILER
+    PROFILER = profiler
+
+
+def get_max_rss():
+    """
+    :rtype: int or None
+    :return: The peak resident set size of the process in bytes, None where the resource module is missing
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def release_tree(html_parser):
+    """
+    Frees a parsed page right away instead of at the next garbage collection, as its nodes reference each other.
+    Decomposing the BeautifulSoup object alone leaves the tree intact, so every top-level node is decomposed.
+    :param html_parser: a BeautifulSoup object, unusable afterwards
+    """
+    for node in list(html_parser.contents):
+        getattr(node, 'decompose', node.extract)()
+    html_parser.decompose()
+
+
+@contextlib.contextmanager
+def _untraced():
+    yield
+
+
+def stage(name):
+    """
+    :param name: one of STAGES
+    :return: A context manager measuring the enclosed code as the named stage, doing nothing without a profiler
+    """
+    return PROFILER.stage(name) if PROFILER is not None else _untraced()
+
+
+def profiled(name):
+    """Decorator measuring every call of the function as the named stage, see :meth:`stage`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MemoryProfiler(object):
+    """
+    Traces allocations with tracemalloc and accounts them to the stage that made them. A stage entered inside
+    another one, e.g. a cache lookup during parsing, is accounted to the outer stage. With a single worker the
+    figures are exact, with more workers allocations of stages running at the same time are mixed.
+
+    ::
+
+        profiler = MemoryProfiler()
+        profiler.start()
+        set_memory_profiler(profiler)
+        get_category("gda")
+        print(profiler.format_report())
+    """
+
+    def __init__(self, frames=1):
+        """
+        :param frames: number of frames kept per allocation traceback, more make :meth:`top` more precise and slower
+        """
+        if tracemalloc is None:
+            raise RuntimeError("Memory profiling requires Python 3.4 or newer")
+        self.frames = frames
+        self.stages = dict((name, self._new_stage()) for name in STAGES)
+        self._peak = 0
+        self._active = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _new_stage():
+        return {'calls': 0, 'seconds': 0.0, 'net_bytes': 0, 'peak': 0}
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def stop(self):
+        tracemalloc.stop()
+
+    def _enter(self):
+        with self._lock:
+            self._active += 1
+            current, peak = tracemalloc.get_traced_memory()
+            # the peak can only be measured per stage when it is reset, the overall peak is kept aside
+            if self._active == 1 and hasattr(tracemalloc, 'reset_peak'):
+                self._peak = max(self._peak, peak)
+                tracemalloc.reset_peak()
+            return current
+
+    def _exit(self, name, started, started_at):
+        with self._lock:
+            self._active -= 1
+            current, peak = tracemalloc.get_traced_memory()
+            counts = self.stages.setdefault(name, self._new_stage())
+            counts['calls'] += 1
+            counts['seconds'] += time.time() - started_at
+            counts['net_bytes'] += current - started
+            counts['peak'] = max(counts['peak'], peak - started)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        :param name: one of STAGES, other names are reported too
+        :return: A context manager measuring the enclosed code
+        """
+        depth = getattr(self._local, 'depth', 0)
+        if depth or not tracemalloc.is_tracing():
+            self._local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.depth = depth
+            return
+        self._local.depth = 1
+        started_at, started = time.time(), self._enter()
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            self._exit(name, started, started_at)
+
+    def report(self):
+        """
+        :rtype: dict
+        :return: Per stage the number of calls, seconds spent, the net change of traced memory over all calls, which
+                 is not the total allocated as memory freed during a call offsets its allocations, and the highest
+                 memory use above the start of a call. Overall the traced memory now and at its peak,
+                 and the peak resident set size of the process.
+        """
+        with self._lock:
+            current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+            return {
+                'stages': dict((name, dict(counts)) for name, counts in self.stages.items()),
+                'current': current,
+                'peak': max(self._peak, peak),
+                'max_rss': get_max_rss(),
+            }
+
+    def top(self, limit=10):
+        """
+        :param limit: number of allocation sites
+        :rtype: list(tuple(string, int, int))
+        :return: The source lines holding the most traced memory now, with their bytes and number of blocks
+        """
+        statistics = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ]).statistics('lineno')
+        return [(str(statistic.traceback[0]), statistic.size, statistic.count) for statistic in statistics[:limit]]
+
+    def format_report(self, limit=10):
+        """
+        :param limit: number of allocation sites listed after the stages, see :meth:`top`
+        :rtype: string
+        :return: :meth:`report` and :meth:`top` as human readable lines
+        """
+        report = self.report()
+        lines = []
+        for name, counts in sorted(report['stages'].items()):
+            lines.append("{0}: calls {1}, {2:.1f}s, net {3}, peak {4}".format(
+                name, counts['calls'], counts['seconds'], _format_bytes(counts['net_bytes']),
+                _format_bytes(counts['peak'])
+            ))
+        lines.append("traced: current {0}, peak {1}, max rss {2}".format(
+            _format_bytes(report['current']), _format_bytes(report['peak']),
+            _format_bytes(report['max_rss']) if report['max_rss'] is not None else "unknown"
+        ))
+        for line, size, count in self.top(limit) if tracemalloc.is_tracing() else []:
+            lines.append("  {0}: {1} in {2} blocks".format(line, _format_bytes(size), count))
+        return "\n".join(lines)
+
+
+def _format_bytes(size):
+    return "{0:.1f} MB".format(size / 1024.0 / 1024)
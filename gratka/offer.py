@@ -10,10 +10,25 @@ import ruamel.yaml as yaml
 from bs4 import BeautifulSoup
 from scrapper_helpers.utils import html_decode, replace_all, _float, _int
 
+from gratka.memory import OFFER_PARSE, profiled, release_tree
 from gratka.utils import get_response_for_url
 
 warnings.simplefilter('ignore', yaml.error.UnsafeLoaderWarning)
 
+# bump whenever parse_offer_information results change, so results cached by older versions are not used
+EXTRACTOR_VERSION = 1
+PARSE_CACHE = None
+
+
+def set_parse_cache(cache):
+    """
+    Makes :meth:`gratka.offer.get_offer_information` reuse results for byte-identical offer pages.
+    :param cache: a :class:`gratka.parse_cache.ParseCache` object or None to parse every page. Its disk tier loads
+                  pickles, so it must be a directory only trusted users can write to.
+    """
+    global PARSE_CACHE
+    PARSE_CACHE = cache
+
 
 def get_offer_apartment_details(html_parser):
     """
@@ -30,17 +45,20 @@ def get_offer_apartment_details(html_parser):
             if raw_data.find_all("li"):
                 item_list = raw_data.find_all("li")
                 for detail in item_list:
-                    details_dict[detail.span.contents[0]] = replace_all(detail.div.text.strip("\n"), replace_dict)
+                    # keys are copied out of the tree, a NavigableString would keep the whole page in memory
+                    key = u"{0}".format(detail.span.contents[0])
+                    details_dict[key] = replace_all(detail.div.text.strip("\n"), replace_dict)
             else:
                 if raw_data.h4.contents[0] == "Opis dodatkowy":
                     raw_data = raw_data.find_next_sibling("div")
                     continue
                 item_list = raw_data.find_all("p")
+                key = u"{0}".format(raw_data.h4.contents[0])
                 for detail in item_list:
                     if raw_data.h4.text not in details_dict:
-                        details_dict[raw_data.h4.contents[0]] = replace_all(detail.text.strip("\n"), replace_dict)
+                        details_dict[key] = replace_all(detail.text.strip("\n"), replace_dict)
                     else:
-                        details_dict[raw_data.h4.contents[0]] += replace_all(detail.text.strip("\n"), replace_dict)
+                        details_dict[key] += replace_all(detail.text.strip("\n"), replace_dict)
             raw_data = raw_data.find_next_sibling("div")
         except AttributeError:
             break
@@ -64,6 +82,7 @@ def get_offer_detail_jsons(markup):
     detail_jsons = []
     for data in raw_data:
         detail_jsons.append(json.loads(data.text))
+    release_tree(html_parser)
     detail_jsons.append(data_layer)
     return detail_jsons[1:]
 
@@ -172,9 +191,9 @@ def get_offer_details(html_parser):
     details = {}
     for detail in raw_detail_data:
         if "Dodano" in detail.text or "Aktualizacja" in detail.text:
-            details[detail.contents[0]] = parse_date_to_timestamp(detail.b.text)
+            details[u"{0}".format(detail.contents[0])] = parse_date_to_timestamp(detail.b.text)
         else:
-            details[detail.contents[0]] = detail.b.text
+            details[u"{0}".format(detail.contents[0])] = detail.b.text
     return details
 
 
@@ -229,12 +248,33 @@ def get_offer_information(url, context=None):
     :param context: a dictionary(string, string) taken straight from the :meth:`gratka.category.get_category`
     :returns: A dictionary containing the scraped offer details
     """
-    response = get_response_for_url(url)
-    content = response.content
+    content = get_response_for_url(url).content
+    if PARSE_CACHE is None:
+        return parse_offer_information(content, context)
+    offer = PARSE_CACHE.get_or_parse(content, parse_offer_information, EXTRACTOR_VERSION)
+    offer['meta']['context'] = context
+    return offer
+
+
+@profiled(OFFER_PARSE)
+def parse_offer_information(content, context=None):
+    """
+    :param content: an offer page body, a requests.response.content object
+    :param context: a dictionary(string, string) taken straight from the :meth:`gratka.category.get_category`
+    :returns: see :meth:`get_offer_information`
+    """
     html_parser = BeautifulSoup(content, "html.parser")
+    try:
+        return _parse_offer_information(html_parser, content, context)
+    finally:
+        release_tree(html_parser)
+
+
+def _parse_offer_information(html_parser, content, context):
     detail_json_list = get_offer_detail_jsons(content)
     offer_apartment_details = get_offer_apartment_details(html_parser)
     return {
+        'offer_id': str(detail_json_list[2].get("id_ogloszenie", "")),
         'title': detail_json_list[0].get("name", ""),
         'surface': _float(detail_json_list[1].get("floorSize", "")) or detail_json_list[1].get("floorSize", ""),
         'rooms': detail_json_list[1].get("numberOfRooms", ""),
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import copy
+import datetime as dt
+import hashlib
+import logging
+import pickle
+import threading
+
+from gratka.memory import CACHE, stage
+from gratka.singleflight import MISSING, StripedCache
+
+log = logging.getLogger(__file__)
+
+
+def get_content_key(content, version):
+    """
+    :param content: a response body
+    :param version: version of the extractor parsing it
+    :rtype: string
+    :return: A key of the body, the extractor version and today's date, because relative dates like 'dzisiaj' are
+             parsed into absolute ones
+    """
+    return "{0}-{1}-{2}".format(version, dt.date.today().isoformat(), hashlib.sha1(content).hexdigest())
+
+
+class ParseCache(object):
+    """
+    Remembers parse results by response body, so byte-identical pages are parsed once. The in-memory tier keeps
+    at most max_size results, the optional disk tier keeps every result between runs. Every call gets its own copy
+    of the result, so callers can modify it.
+
+    Results on disk are pickled, and unpickling can run arbitrary code, so the disk cache directory must be
+    writable only by trusted users.
+    """
+
+    def __init__(self, max_size=1024, disk=None):
+        """
+        :param max_size: number of results kept in memory
+        :param disk: a :class:`gratka.compression.CompressedCache` or None
+        """
+        self.memory = StripedCache(max_size=max_size)
+        self.disk = disk
+        self._lock = threading.Lock()
+        self.counts = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def _load(self, key, content, parse):
+        if self.disk is not None:
+            with stage(CACHE):
+                blob = self.disk.get(key)
+                result = pickle.loads(blob) if blob is not None else MISSING
+            if result is not MISSING:
+                self._count('disk_hits')
+                return result
+        self._count('misses')
+        result = parse(content)
+        if self.disk is not None:
+            with stage(CACHE):
+                self.disk.set(key, pickle.dumps(result, 2))
+        return result
+
+    def get_or_parse(self, content, parse, version):
+        """
+        :param content: a response body
+        :param parse: a function taking the body and returning the parse result
+        :param version: version of the parse function, results of other versions are not used
+        :return: A copy of the parse result
+        """
+        key = get_content_key(content, version)
+        with stage(CACHE):
+            result = self.memory.get(key, MISSING)
+        if result is MISSING:
+            result = self.memory.get_or_set(key, self._load, key, content, parse)
+        else:
+            self._count('memory_hits')
+        with stage(CACHE):
+            return copy.deepcopy(result)
+
+    def stats(self):
+        """
+        :rtype: dict(string, int)
+        :return: number of memory hits, disk hits and misses
+        """
+        with self._lock:
+            return dict(self.counts)
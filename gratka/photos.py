@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from gratka.utils import CHUNK_SIZE
+from scrapper_helpers.utils import get_random_user_agent
+
+if sys.version_info < (3, 3):
+    from urlparse import urlparse
+else:
+    from urllib.parse import urlparse
+
+log = logging.getLogger(__file__)
+
+MANIFEST_NAME = "manifest.json"
+
+
+def get_photo_extension(url):
+    """
+    :param url: a photo link from :meth:`gratka.offer.get_offer_photos_links`
+    :rtype: string
+    :return: The file extension of the photo, '.jpg' if the url has none
+    """
+    extension = os.path.splitext(urlparse(url).path)[1]
+    return extension.lower() if extension else ".jpg"
+
+
+class PhotoDownloader(object):
+    """
+    Downloads offer photos concurrently into a single directory. Photos are streamed to disk and named after the
+    SHA-1 of their content, so the same photo reused by an agency in many offers is stored once. A manifest maps
+    every downloaded url to its file, so urls downloaded by an earlier run are skipped.
+    """
+
+    def __init__(self, directory, max_workers=8, timeout=30):
+        self.directory = directory
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.stats = dict.fromkeys(['downloaded', 'duplicates', 'skipped', 'failed', 'bytes'], 0)
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+    def _count(self, stat, value=1):
+        with self._lock:
+            self.stats[stat] += value
+
+    def save_manifest(self):
+        with self._lock:
+            manifest = dict(self.manifest)
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        with os.fdopen(descriptor, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.rename(temporary_path, self.manifest_path)
+
+    def download(self, url):
+        """
+        :param url: a photo link from :meth:`gratka.offer.get_offer_photos_links`
+        :rtype: string or None
+        :return: Path of the downloaded photo, None if the download failed
+        """
+        known = self.manifest.get(url)
+        if known and os.path.exists(os.path.join(self.directory, known)):
+            self._count('skipped')
+            return os.path.join(self.directory, known)
+
+        digest = hashlib.sha1()
+        temporary_path = None
+        try:
+            response = requests.get(url, headers={'User-Agent': get_random_user_agent()}, stream=True,
+                                    timeout=self.timeout)
+            # a streamed response left half-read would hold its connection
+            with contextlib.closing(response):
+                response.raise_for_status()
+                # created only once there is a body to write, the file object closes the descriptor
+                descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+                with os.fdopen(descriptor, "wb") as photo_file:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        digest.update(chunk)
+                        photo_file.write(chunk)
+                        self._count('bytes', len(chunk))
+        except (requests.RequestException, IOError) as e:
+            log.warning("Photo download failed - {0}: {1!r}".format(url, e))
+            self._count('failed')
+            if temporary_path is not None:
+                os.remove(temporary_path)
+            return None
+
+        name = digest.hexdigest() + get_photo_extension(url)
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            if os.path.exists(path):
+                os.remove(temporary_path)
+                self.stats['duplicates'] += 1
+            else:
+                os.rename(temporary_path, path)
+                self.stats['downloaded'] += 1
+            self.manifest[url] = name
+        return path
+
+    def download_offers(self, offers):
+        """
+        Downloads photos of all the given offers.
+        :param offers: an iterable of dicts returned by :meth:`gratka.offer.get_offer_information`
+        :rtype: dict(string, string)
+        :return: A dictionary mapping photo urls to paths of the downloaded files
+        """
+        urls, seen = [], set()
+        for offer in offers:
+            for url in offer.get('photo_links', []):
+                if url and url not in seen:
+                    seen.add(url)
+                    urls.append(url)
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                paths = dict(zip(urls, executor.map(self.download, urls)))
+        finally:
+            self.save_manifest()
+        return dict((url, path) for url, path in paths.items() if path)
+
+
+def download_offer_photos(offers, directory, max_workers=8):
+    """
+    :param offers: an iterable of dicts returned by :meth:`gratka.offer.get_offer_information`
+    :param directory: where the photos will be stored
+    :param max_workers: maximal number of concurrent downloads
+    :rtype: dict(string, string)
+    :return: see :meth:`PhotoDownloader.download_offers`
+    """
+    return PhotoDownloader(directory, max_workers=max_workers).download_offers(offers)
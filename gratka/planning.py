@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from gratka.category import (
+    get_category_number_of_pages, get_distinct_category_page, parse_category_content, was_category_search_successful
+)
+from gratka.offer import get_offer_information
+from gratka.utils import get_rate_limit, get_response_for_url, get_url
+
+log = logging.getLogger(__file__)
+
+# size of an offer page body, measured on test_data/offer
+AVERAGE_DETAIL_BYTES = 160 * 1024
+
+
+class CrawlPlan(object):
+    """
+    What a crawl of one category will cost, known after fetching only its first page. The parsed first page is
+    kept, so :meth:`execute` doesn't fetch it again.
+
+    ::
+
+        plan = plan_crawl("gda", details=True, category_root=100382, category_changer=100401)
+        if plan.estimated_requests < 500:
+            offers = plan.execute()
+    """
+
+    def __init__(self, region, filters, pages_count, first_page_offers, first_page_bytes=0, first_page_seconds=0,
+                 details=False, rate=None, workers=1, detail_bytes=AVERAGE_DETAIL_BYTES, listing_details=False):
+        self.region = region
+        self.filters = filters
+        self.pages_count = pages_count
+        self.first_page_offers = first_page_offers
+        self.first_page_bytes = first_page_bytes
+        self.first_page_seconds = first_page_seconds
+        self.details = details
+        self.rate = rate
+        self.workers = workers
+        self.detail_bytes = detail_bytes
+        self.listing_details = listing_details
+
+    @property
+    def estimated_offers(self):
+        """An upper bound, every page is assumed to be as full as the first one."""
+        return len(self.first_page_offers) * self.pages_count
+
+    @property
+    def estimated_requests(self):
+        """Requests still needed, the first page is already fetched."""
+        return max(self.pages_count - 1, 0) + (self.estimated_offers if self.details else 0)
+
+    @property
+    def estimated_bytes(self):
+        return (max(self.pages_count - 1, 0) * self.first_page_bytes +
+                (self.estimated_offers * self.detail_bytes if self.details else 0))
+
+    @property
+    def estimated_seconds(self):
+        """The longer of the time allowed by the rate limit and the time workers need at the first page latency."""
+        requests = self.estimated_requests
+        return max(float(requests) / self.rate if self.rate else 0,
+                   requests * self.first_page_seconds / max(self.workers, 1))
+
+    def to_dict(self):
+        """
+        :rtype: dict
+        :return: The plan without the first page offers, e.g. to be printed as JSON
+        """
+        return {
+            'region': self.region,
+            'filters': self.filters,
+            'pages_count': self.pages_count,
+            'estimated_offers': self.estimated_offers,
+            'estimated_requests': self.estimated_requests,
+            'estimated_bytes': self.estimated_bytes,
+            'estimated_seconds': round(self.estimated_seconds, 1),
+        }
+
+    def get_page(self, page):
+        """
+        :param page: page number
+        :rtype: list(dict)
+        :return: see :meth:`gratka.category.get_distinct_category_page`, the first page without a request
+        """
+        if page == 1:
+            return list(self.first_page_offers)
+        return get_distinct_category_page(page, self.region, listing_details=self.listing_details, **self.filters)
+
+    @staticmethod
+    def get_details(offer):
+        """
+        :param offer: a dict returned by :meth:`get_page`
+        :rtype: dict or None
+        :return: see :meth:`gratka.offer.get_offer_information`, None if the offer couldn't be scraped
+        """
+        try:
+            return get_offer_information(offer['detail_url'], context=offer)
+        except Exception as e:
+            # e.g. IndexError for offers which are not active anymore
+            log.warning("Offer not scraped - {0}: {1!r}".format(offer['detail_url'], e))
+            return None
+
+    def execute(self):
+        """
+        Scrapes the rest of the category with the planned number of workers.
+        :rtype: list(dict)
+        :return: see :meth:`gratka.category.get_category`, or :meth:`gratka.offer.get_offer_information` results for
+                 plans made with details, offers whose details couldn't be scraped are left out
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            offers = [offer for page in executor.map(self.get_page, range(1, self.pages_count + 1))
+                      for offer in page if offer]
+            if self.details:
+                offers = [offer for offer in executor.map(self.get_details, offers) if offer is not None]
+        return offers
+
+
+def plan_crawl(region, details=False, rate=None, workers=1, listing_details=False, **filters):
+    """
+    Fetches the first page of a category and estimates the cost of scraping all of it.
+    :param region: see :meth:`gratka.category.get_category` for reference
+    :param details: whether offer details are going to be scraped as well
+    :param rate: requests per second, the rate set with :meth:`gratka.utils.set_rate_limit` by default
+    :param workers: number of concurrent requests
+    :param listing_details: see :meth:`gratka.category.get_category`
+    :param filters: see :meth:`gratka.category.get_category` for reference
+    :rtype: CrawlPlan
+    """
+    rate = rate if rate is not None else get_rate_limit()
+    url = get_url(region, 1, **filters)
+    started = time.time()
+    content = get_response_for_url(url).content
+    seconds = time.time() - started
+    if not was_category_search_successful(content):
+        log.warning("Search for category wasn't successful: {0}".format(url))
+        pages_count, offers = 0, []
+    else:
+        pages_count = get_category_number_of_pages(content)
+        offers = parse_category_content(content, listing_details)
+    return CrawlPlan(region, filters, pages_count, offers, len(content), seconds, details=details, rate=rate,
+                     workers=workers, listing_details=listing_details)
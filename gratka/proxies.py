@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import itertools
+import logging
+import threading
+import time
+
+from scrapper_helpers.utils import get_random_user_agent
+
+log = logging.getLogger(__file__)
+
+ROUND_ROBIN = 'round_robin'
+LEAST_LATENCY = 'least_latency'
+STRATEGIES = (ROUND_ROBIN, LEAST_LATENCY)
+
+THROTTLED_STATUSES = (429, 503)
+# weight of the latest request in the moving average of an endpoint latency
+LATENCY_SMOOTHING = 0.2
+
+
+class Endpoint(object):
+    """
+    A proxy, or the direct connection when url is None, with its own user agent and health statistics.
+    """
+
+    def __init__(self, url=None, user_agent=None):
+        self.url = url
+        self.user_agent = user_agent or get_random_user_agent()
+        self.requests = 0
+        self.failures = 0
+        self.throttled = 0
+        self.latency = None
+        self.cooldown_until = 0
+
+    @property
+    def proxies(self):
+        """:return: the proxies argument for requests"""
+        return {'http': self.url, 'https': self.url} if self.url else None
+
+    @property
+    def success_rate(self):
+        return float(self.requests - self.failures - self.throttled) / self.requests if self.requests else 1.0
+
+    def to_dict(self):
+        return {
+            'url': self.url, 'requests': self.requests, 'failures': self.failures, 'throttled': self.throttled,
+            'success_rate': self.success_rate, 'latency': self.latency,
+            'cooling_down': self.cooldown_until > time.time(),
+        }
+
+
+class ProxyPool(object):
+    """
+    Spreads requests over a pool of proxies. Endpoints are picked round-robin or by the lowest average latency,
+    skipping endpoints that were throttled or failed during the last cooldown seconds. Every endpoint always sends
+    the same user agent, so the site sees a consistent client per address.
+
+    ::
+
+        set_proxy_pool(ProxyPool(["http://10.0.0.1:3128", "http://10.0.0.2:3128"], strategy=LEAST_LATENCY))
+    """
+
+    def __init__(self, proxies, strategy=ROUND_ROBIN, cooldown=60):
+        """
+        :param proxies: a list of proxy urls, None stands for the direct connection
+        :param strategy: ROUND_ROBIN or LEAST_LATENCY
+        :param cooldown: seconds an endpoint is skipped after being throttled or failing
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown strategy {0!r}".format(strategy))
+        if not proxies:
+            raise ValueError("A proxy pool needs at least one endpoint")
+        self.endpoints = [Endpoint(url) for url in proxies]
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self._order = itertools.cycle(range(len(self.endpoints)))
+        self._lock = threading.Lock()
+
+    def _pick(self, available):
+        if self.strategy == LEAST_LATENCY:
+            # endpoints without a measurement yet are tried first
+            return min(available, key=lambda endpoint: endpoint.latency or 0)
+        while True:
+            endpoint = self.endpoints[next(self._order)]
+            if endpoint in available:
+                return endpoint
+
+    def acquire(self):
+        """
+        :rtype: Endpoint
+        :return: The endpoint to send the next request through, waits if every endpoint is cooling down
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                available = [endpoint for endpoint in self.endpoints if endpoint.cooldown_until <= now]
+                if available:
+                    return self._pick(available)
+                delay = min(endpoint.cooldown_until for endpoint in self.endpoints) - now
+            log.info("Every endpoint is cooling down, waiting {0:.1f}s".format(delay))
+            time.sleep(delay)
+
+    def report(self, endpoint, status_code=None, seconds=None, error=None):
+        """
+        Updates the endpoint statistics with the outcome of a request.
+        :param endpoint: an endpoint returned by :meth:`acquire`
+        :param status_code: HTTP status code of the response
+        :param seconds: time until the response headers arrived
+        :param error: the exception raised instead of a response
+        """
+        with self._lock:
+            endpoint.requests += 1
+            if seconds is not None:
+                endpoint.latency = seconds if endpoint.latency is None else (
+                    LATENCY_SMOOTHING * seconds + (1 - LATENCY_SMOOTHING) * endpoint.latency
+                )
+            if error is not None or status_code in THROTTLED_STATUSES:
+                if error is not None:
+                    endpoint.failures += 1
+                else:
+                    endpoint.throttled += 1
+                endpoint.cooldown_until = time.time() + self.cooldown
+                log.warning("Cooling down {0} after {1!r}".format(endpoint.url or "direct", error or status_code))
+
+    def send(self, send, url, headers, **kwargs):
+        """
+        :param send: requests.get, requests.post or a function with the same signature
+        :param url: the url to request
+        :param headers: request headers, the User-Agent is set by the endpoint
+        :return: a requests.response object
+        """
+        endpoint = self.acquire()
+        headers = dict(headers, **{'User-Agent': endpoint.user_agent})
+        started = time.time()
+        try:
+            response = send(url, headers=headers, proxies=endpoint.proxies, **kwargs)
+        except Exception as e:
+            self.report(endpoint, error=e)
+            raise
+        self.report(endpoint, response.status_code, time.time() - started)
+        return response
+
+    def stats(self):
+        """
+        :rtype: list(dict)
+        :return: requests, failures, throttled responses, success rate, average latency and cooldown per endpoint
+        """
+        with self._lock:
+            return [endpoint.to_dict() for endpoint in self.endpoints]
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+
+if sys.version_info < (3, 3):
+    from urlparse import urlparse
+else:
+    from urllib.parse import urlparse
+
+log = logging.getLogger(__file__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(IOError):
+    """Raised instead of sending a request to a host that keeps failing."""
+
+
+class RetryPolicy(object):
+    """
+    Retries failed requests up to attempts times in total, waiting a random time between 0 and
+    backoff * 2 ** retry seconds, capped at max_backoff, or longer if the server sent a Retry-After header.
+    """
+
+    def __init__(self, attempts=3, backoff=0.5, max_backoff=30, statuses=RETRY_STATUSES):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = statuses
+
+    def get_delay(self, retry, response=None):
+        """
+        :param retry: number of retries made so far
+        :param response: the failed response, None if the request raised an exception
+        :rtype: float
+        :return: seconds to wait before the next attempt
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))
+        retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+        if retry_after.isdigit():
+            delay = max(delay, min(int(retry_after), self.max_backoff))
+        return delay
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to a host after failure_threshold failures in a row. After reset_timeout seconds
+    a single trial request is let through, closing the circuit again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _get_host(self, host):
+        return self._hosts.setdefault(host, {'state': CLOSED, 'failures': 0, 'opened': 0})
+
+    def state(self, host):
+        with self._lock:
+            return self._get_host(host)['state']
+
+    def before(self, host):
+        """
+        :raises CircuitOpenError: if requests to the host are not allowed now
+        """
+        with self._lock:
+            circuit = self._get_host(host)
+            if circuit['state'] == CLOSED:
+                return
+            if circuit['state'] == OPEN and time.time() - circuit['opened'] >= self.reset_timeout:
+                circuit['state'] = HALF_OPEN
+                return
+        raise CircuitOpenError("Circuit for {0} is open".format(host))
+
+    def record_success(self, host):
+        with self._lock:
+            circuit = self._get_host(host)
+            circuit['state'], circuit['failures'] = CLOSED, 0
+
+    def record_failure(self, host):
+        with self._lock:
+            circuit = self._get_host(host)
+            circuit['failures'] += 1
+            if circuit['state'] == HALF_OPEN or circuit['failures'] >= self.failure_threshold:
+                if circuit['state'] != OPEN:
+                    log.warning("Opening circuit for {0} after {1} failures".format(host, circuit['failures']))
+                circuit['state'], circuit['opened'] = OPEN, time.time()
+
+
+class LatencyTracker(object):
+    """Keeps the latencies of the last window requests and tells their percentile."""
+
+    def __init__(self, window=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction):
+        """
+        :rtype: float or None
+        :return: The latency fraction of the requests were faster than, None before min_samples requests
+        """
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+
+
+class Resilience(object):
+    """
+    Wraps single request attempts with retries, a per-host circuit breaker and optional hedging: when a request
+    takes longer than hedge_percentile of recent requests, a duplicate is sent and the first response wins.
+
+    ::
+
+        set_resilience(Resilience(RetryPolicy(attempts=4), hedge_percentile=0.95))
+    """
+
+    def __init__(self, retry=None, breaker=None, hedge_percentile=None, latencies=None, hedge_workers=8):
+        """
+        :param retry: a :class:`RetryPolicy`, one attempt without retries if None
+        :param breaker: a :class:`CircuitBreaker` or None
+        :param hedge_percentile: e.g. 0.95, None disables hedging
+        :param latencies: a :class:`LatencyTracker`, a new one by default
+        :param hedge_workers: number of threads sending hedged requests
+        """
+        self.retry = retry or RetryPolicy(attempts=1)
+        self.breaker = breaker
+        self.hedge_percentile = hedge_percentile
+        self.latencies = latencies or LatencyTracker()
+        self._executor = ThreadPoolExecutor(max_workers=hedge_workers) if hedge_percentile else None
+        self._lock = threading.Lock()
+        self.counts = {'retries': 0, 'hedges': 0, 'hedge_wins': 0, 'rejected': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def _timed(self, fetch, url):
+        started = time.time()
+        response = fetch(url)
+        self.latencies.add(time.time() - started)
+        return response
+
+    def _hedged(self, fetch, url, before_request):
+        # waiting for a rate limit is not part of the request latency, nor of the time before hedging
+        threshold = self.latencies.percentile(self.hedge_percentile) if self._executor is not None else None
+        if before_request is not None:
+            before_request()
+        if threshold is None:
+            return self._timed(fetch, url)
+        first = self._executor.submit(self._timed, fetch, url)
+        try:
+            return first.result(timeout=threshold)
+        except TimeoutError:
+            pass
+        if before_request is not None:
+            before_request()
+        self._count('hedges')
+        pending = set([first, self._executor.submit(self._timed, fetch, url)])
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except IOError as e:
+                    error = e
+                    continue
+                if future is not first:
+                    self._count('hedge_wins')
+                return response
+        raise error
+
+    def call(self, fetch, url, before_request=None):
+        """
+        :param fetch: a function sending a single request for url and returning a requests.response object
+        :param url: the url to fetch
+        :param before_request: a function called before every request and hedge, e.g. waiting for a rate limit,
+                               not counted as latency
+        :return: The first successful response, or the last failed one once all attempts are used
+        :raises CircuitOpenError: if the circuit for the url host is open
+        """
+        host = urlparse(url).netloc
+        retries = 0
+        while True:
+            if self.breaker is not None:
+                try:
+                    self.breaker.before(host)
+                except CircuitOpenError:
+                    self._count('rejected')
+                    raise
+            response, error = None, None
+            try:
+                response = self._hedged(fetch, url, before_request)
+            except IOError as e:
+                error = e
+            except BaseException:
+                # any outcome has to be recorded, or a half open circuit would never close or open again
+                if self.breaker is not None:
+                    self.breaker.record_failure(host)
+                raise
+            failed = error is not None or response.status_code in self.retry.statuses
+            if self.breaker is not None:
+                (self.breaker.record_failure if failed else self.breaker.record_success)(host)
+            if not failed:
+                return response
+            if retries + 1 >= self.retry.attempts:
+                if error is not None:
+                    raise error
+                return response
+            delay = self.retry.get_delay(retries, response)
+            log.info("Retrying {0} in {1:.1f}s after {2!r}".format(
+                url, delay, error if error is not None else response.status_code
+            ))
+            self._count('retries')
+            time.sleep(delay)
+            retries += 1
+
+    def stats(self):
+        """
+        :rtype: dict(string, int)
+        :return: number of retries, hedged requests, hedges that answered first and requests rejected by the breaker
+        """
+        with self._lock:
+            return dict(self.counts)
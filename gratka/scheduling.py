@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+log = logging.getLogger(__file__)
+
+
+def _int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def by_listing_order(offer):
+    """Keeps offers in the order they were scheduled, like a crawl without a scheduler."""
+    return 0
+
+
+def by_recency(offer):
+    """Newest offers first. Offer ids are assigned in increasing order, so a higher id is a more recent listing."""
+    return -_int(offer.get('offer_id'), 0)
+
+
+def by_offer_points(offer):
+    """Most promoted offers first."""
+    return -_int(offer.get('offer_points'), 0)
+
+
+def by_offer_position(offer):
+    """Offers placed highest on their listing page first."""
+    return _int(offer.get('offer_position'), float('inf'))
+
+
+def unseen_first(seen):
+    """
+    :param seen: a container of offer ids fetched before, e.g. a :class:`gratka.dedup.OfferIndex`
+    :return: a priority function putting offers not in seen first
+    """
+    def priority(offer):
+        return 1 if offer.get('offer_id') in seen else 0
+    return priority
+
+
+def combine(*priorities):
+    """
+    :param priorities: priority functions, the first one decides and the next ones break ties
+    :return: a priority function
+    """
+    def priority(offer):
+        return tuple(function(offer) for function in priorities)
+    return priority
+
+
+PRIORITIES = {
+    'listing': by_listing_order,
+    'recency': by_recency,
+    'points': by_offer_points,
+    'position': by_offer_position,
+}
+
+
+def get_priority(names, seen=None):
+    """
+    :param names: a list of PRIORITIES keys or 'unseen', e.g. ['unseen', 'recency']
+    :param seen: a container of offer ids fetched before, required by 'unseen'
+    :return: a priority function
+    """
+    priorities = []
+    for name in names:
+        if name == 'unseen':
+            if seen is None:
+                raise ValueError("'unseen' priority requires offer ids fetched before")
+            priorities.append(unseen_first(seen))
+        elif name in PRIORITIES:
+            priorities.append(PRIORITIES[name])
+        else:
+            raise ValueError("Unknown priority {0!r}".format(name))
+    return combine(*priorities)
+
+
+class DetailScheduler(object):
+    """
+    A thread-safe priority queue of offers waiting for :meth:`gratka.offer.get_offer_information`. The offer with the
+    lowest priority value comes out first, offers with equal priority keep the order they were pushed in.
+    Once max_fetches offers were taken or time_budget seconds passed, the queued offers are dropped.
+
+    ::
+
+        scheduler = DetailScheduler(combine(unseen_first(index), by_recency), max_fetches=100)
+        scheduler.push_many(get_category("gda"))
+        offer = scheduler.pop()
+        while offer is not None:
+            get_offer_information(offer['detail_url'], context=offer)
+            offer = scheduler.pop()
+    """
+
+    def __init__(self, priority=None, max_fetches=None, time_budget=None, seen=None):
+        """
+        :param priority: a function taking a dict returned by :meth:`gratka.category.get_category` and returning a
+                         sortable value, by_listing_order by default
+        :param max_fetches: maximal number of offers to take
+        :param time_budget: seconds from now after which no more offers are taken
+        :param seen: a container of offer ids with an add method, :meth:`done` adds fetched offers to it
+        """
+        self.priority = priority or by_listing_order
+        self.max_fetches = max_fetches
+        self.deadline = time.time() + time_budget if time_budget is not None else None
+        self.seen = seen
+        self.taken = 0
+        self.dropped = 0
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    @property
+    def exhausted(self):
+        """Whether the fetch or time budget is used up."""
+        return ((self.max_fetches is not None and self.taken >= self.max_fetches) or
+                (self.deadline is not None and time.time() >= self.deadline))
+
+    def push(self, offer):
+        """
+        :param offer: a dict returned by :meth:`gratka.category.get_category`
+        """
+        entry = (self.priority(offer), next(self._counter), offer)
+        with self._lock:
+            if self.exhausted:
+                self.dropped += 1
+                return
+            heapq.heappush(self._heap, entry)
+
+    def push_many(self, offers):
+        for offer in offers:
+            if offer:
+                self.push(offer)
+
+    def pop(self):
+        """
+        :rtype: dict or None
+        :return: The queued offer with the highest priority, None if the queue is empty or the budget is used up
+        """
+        with self._lock:
+            if self._heap and self.exhausted:
+                log.info("Budget used up, dropping {0} offers".format(len(self._heap)))
+                self.dropped += len(self._heap)
+                self._heap = []
+            if not self._heap:
+                return None
+            self.taken += 1
+            return heapq.heappop(self._heap)[-1]
+
+    def done(self, offer):
+        """
+        Marks the offer as fetched, so unseen_first over the same seen container puts it last in later runs.
+        :param offer: a dict returned by :meth:`gratka.offer.get_offer_information`
+        """
+        offer_id = offer.get('offer_id') or (offer.get('meta', {}).get('context') or {}).get('offer_id')
+        if self.seen is not None and offer_id:
+            self.seen.add(offer_id)
+
+    def stats(self):
+        """
+        :rtype: dict(string, int)
+        :return: number of offers taken, queued and dropped
+        """
+        return {'taken': self.taken, 'queued': len(self._heap), 'dropped': self.dropped}
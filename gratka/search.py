@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import bisect
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+
+from scrapper_helpers.utils import normalize_text
+
+log = logging.getLogger(__file__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+INDEXED_FIELDS = ('title', 'description')
+
+
+def tokenize(text):
+    """
+    This method splits text into search tokens, folding case and Polish diacritics with the same
+    normalize_text that :meth:`gratka.utils.get_region_from_autosuggest` uses.
+    :param text: input string
+    :rtype: list(string)
+    """
+    # ł has no unicode decomposition, so normalize_text would drop it instead of folding it to l
+    text = (text or "").replace(u"ł", u"l").replace(u"Ł", u"L")
+    return TOKEN_PATTERN.findall(normalize_text(text, replace_spaces=None))
+
+
+class InvertedIndex(object):
+    """
+    A local keyword index over offer titles and descriptions, queried with the same syntax as the keyword filter of
+    :meth:`gratka.category.get_category`: alternatives are separated by ',' (OR), words of one alternative must all
+    be present (AND). A word prefixed with '-' must be absent and a word ending with '*' matches any word starting
+    with it, e.g. 'balkon*, taras -parter'.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._documents = {}
+        self._vocabulary = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self, document_id):
+        return document_id in self._documents
+
+    def add(self, document_id, text):
+        """
+        Indexes the text, replacing whatever was indexed under document_id before.
+        :param document_id: any JSON serializable hashable, most likely an offer_id
+        :param text: input string
+        """
+        tokens = frozenset(tokenize(text))
+        with self._lock:
+            self.remove(document_id)
+            self._documents[document_id] = tokens
+            for token in tokens:
+                if token not in self._postings:
+                    self._postings[token] = set()
+                    self._vocabulary = None
+                self._postings[token].add(document_id)
+
+    def add_offer(self, offer):
+        """
+        :param offer: a dict returned by :meth:`gratka.offer.get_offer_information`
+        """
+        offer_id = offer.get('offer_id') or (offer.get('meta', {}).get('context') or {}).get('offer_id')
+        if not offer_id:
+            raise ValueError("Offer has no offer_id")
+        self.add(offer_id, " ".join(offer.get(field) or "" for field in INDEXED_FIELDS))
+
+    def add_offers(self, offers):
+        for offer in offers:
+            self.add_offer(offer)
+
+    def remove(self, document_id):
+        """
+        :rtype: boolean
+        :return: False if nothing was indexed under document_id
+        """
+        with self._lock:
+            tokens = self._documents.pop(document_id, None)
+            if tokens is None:
+                return False
+            for token in tokens:
+                postings = self._postings[token]
+                postings.discard(document_id)
+                if not postings:
+                    del self._postings[token]
+                    self._vocabulary = None
+            return True
+
+    def _match(self, word):
+        if not word.endswith("*"):
+            return self._postings.get(word, set())
+        prefix = word[:-1]
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        matched = set()
+        for token in self._vocabulary[bisect.bisect_left(self._vocabulary, prefix):]:
+            if not token.startswith(prefix):
+                break
+            matched.update(self._postings[token])
+        return matched
+
+    def _match_alternative(self, alternative):
+        included, excluded = [], []
+        for word in alternative.split():
+            negated = word.startswith("-")
+            wildcard = word.endswith("*")
+            tokens = tokenize(word)
+            if wildcard and tokens:
+                tokens[-1] += "*"
+            (excluded if negated else included).extend(tokens)
+        if not included:
+            return set()
+        matched = None
+        for token in sorted(included, key=lambda token: len(self._postings.get(token, ()))):
+            matched = set(self._match(token)) if matched is None else matched & self._match(token)
+            if not matched:
+                return set()
+        for token in excluded:
+            matched -= self._match(token)
+        return matched
+
+    def search(self, query):
+        """
+        :param query: see the class description for the syntax
+        :rtype: list
+        :return: sorted ids of the matching documents
+        """
+        matched = set()
+        with self._lock:
+            for alternative in query.split(","):
+                matched |= self._match_alternative(alternative)
+        return sorted(matched)
+
+    def save(self, path):
+        """Stores the index as gzipped JSON, written to a temporary file first so readers never see half of it."""
+        with self._lock:
+            documents = [[document_id, " ".join(sorted(tokens))] for document_id, tokens in self._documents.items()]
+        temporary_path = path + ".tmp"
+        with gzip.open(temporary_path, "wb") as index_file:
+            index_file.write(json.dumps({'documents': documents}).encode("utf-8"))
+        os.rename(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: a file written by :meth:`save`
+        :rtype: InvertedIndex
+        """
+        index = cls()
+        with gzip.open(path, "rb") as index_file:
+            documents = json.loads(index_file.read().decode("utf-8"))['documents']
+        for document_id, tokens in documents:
+            index.add(document_id, tokens)
+        return index
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import functools
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+log = logging.getLogger(__file__)
+
+MISSING = object()
+
+
+class _Call(object):
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the function, callers arriving while it
+    runs wait for it and get the same result or exception instead of running it again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        :param key: any hashable identifying the call
+        :param func: the function to run, called with args and kwargs
+        :return: The result of func
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class AsyncSingleFlight(object):
+    """
+    :class:`SingleFlight` for coroutines running in one event loop: concurrent callers of the same key await the
+    same task.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self.coalesced = 0
+
+    def do(self, key, coroutine_function, *args, **kwargs):
+        """
+        :param key: any hashable identifying the call
+        :param coroutine_function: called with args and kwargs if no call for key is running
+        :return: an awaitable of the coroutine result
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(coroutine_function(*args, **kwargs))
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        else:
+            self.coalesced += 1
+        # a cancelled caller must not cancel the call for everybody else
+        return asyncio.shield(task)
+
+
+class StripedCache(object):
+    """
+    A thread-safe in-memory cache split into stripes, each with its own lock, so threads working on different keys
+    rarely wait for each other. Locks are only held for dictionary operations, never while computing a value, so
+    the cache can also be used from coroutines. With max_size set, every stripe evicts its least recently used
+    entries.
+    """
+
+    def __init__(self, stripes=16, max_size=None):
+        self._stripes = [(threading.Lock(), OrderedDict()) for _ in range(stripes)]
+        self.max_stripe_size = -(-max_size // stripes) if max_size else None
+        self._flight = SingleFlight()
+
+    def _get_stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def get(self, key, default=None):
+        lock, entries = self._get_stripe(key)
+        with lock:
+            value = entries.pop(key, MISSING)
+            if value is MISSING:
+                return default
+            entries[key] = value
+            return value
+
+    def set(self, key, value):
+        lock, entries = self._get_stripe(key)
+        with lock:
+            entries.pop(key, None)
+            entries[key] = value
+            while self.max_stripe_size is not None and len(entries) > self.max_stripe_size:
+                entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        lock, entries = self._get_stripe(key)
+        with lock:
+            return entries.pop(key, default)
+
+    def clear(self):
+        for lock, entries in self._stripes:
+            with lock:
+                entries.clear()
+
+    def __contains__(self, key):
+        lock, entries = self._get_stripe(key)
+        with lock:
+            return key in entries
+
+    def __len__(self):
+        return sum(len(entries) for _, entries in self._stripes)
+
+    def _load(self, key, func, args, kwargs):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            value = func(*args, **kwargs)
+            self.set(key, value)
+        return value
+
+    def get_or_set(self, key, func, *args, **kwargs):
+        """
+        :return: The cached value, or the result of func called with args and kwargs, computed once for all
+                 concurrent callers and cached
+        """
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            value = self._flight.do(key, self._load, key, func, args, kwargs)
+        return value
+
+
+def coalesce(key_func, cache=None):
+    """
+    A decorator making concurrent calls of the decorated function with the same key run it once.
+    :param key_func: called with the function arguments, returns a hashable key
+    :param cache: a :class:`StripedCache` keeping results for later calls, None to only coalesce running calls
+    """
+
+    def decorator(func):
+        flight = SingleFlight()
+
+        @functools.wraps(func)
+        def decorated(*args, **kwargs):
+            key = key_func(*args, **kwargs)
+            if cache is not None:
+                return cache.get_or_set(key, func, *args, **kwargs)
+            return flight.do(key, func, *args, **kwargs)
+
+        decorated.single_flight = cache._flight if cache is not None else flight
+        return decorated
+
+    return decorator
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import sqlite3
+import time
+
+log = logging.getLogger(__file__)
+
+# offers table columns after offer_id, set by category results and by offer details
+LISTING_COLUMNS = (('detail_url', 'TEXT'), ('offer_position', 'INTEGER'), ('offer_points', 'INTEGER'))
+DETAIL_COLUMNS = (
+    ('title', 'TEXT'), ('price', 'REAL'), ('currency', 'TEXT'), ('additional_rent', 'REAL'), ('surface', 'REAL'),
+    ('rooms', 'INTEGER'), ('floor', 'INTEGER'), ('total_floors', 'INTEGER'), ('city', 'TEXT'), ('district', 'TEXT'),
+    ('voivodeship', 'TEXT'), ('address', 'TEXT'), ('latitude', 'REAL'), ('longitude', 'REAL'),
+    ('poster_name', 'TEXT'), ('poster_type', 'TEXT'), ('company_name', 'TEXT'), ('phone_numbers', 'TEXT'),
+    ('description', 'TEXT'), ('video_link', 'TEXT'), ('photo_links', 'TEXT'), ('offer_details', 'TEXT'),
+    ('is_active', 'INTEGER'),
+)
+COLUMNS = tuple(name for name, _ in LISTING_COLUMNS + DETAIL_COLUMNS)
+
+APARTMENT_DETAILS = 0
+ADDITIONAL_ASSETS = 1
+
+# INSERT ... ON CONFLICT DO UPDATE, older versions insert or ignore and then update
+UPSERT_SQLITE_VERSION = (3, 24, 0)
+
+OFFERS_TABLE = """
+CREATE TABLE IF NOT EXISTS offers (
+    offer_id TEXT PRIMARY KEY,
+{0},
+    updated_at REAL NOT NULL
+);"""
+
+SCHEMA = OFFERS_TABLE.format(",\n".join(
+    "    {0} {1}".format(name, column_type) for name, column_type in LISTING_COLUMNS + DETAIL_COLUMNS
+)) + """
+CREATE INDEX IF NOT EXISTS offers_by_price ON offers (price);
+CREATE INDEX IF NOT EXISTS offers_by_surface ON offers (surface);
+CREATE INDEX IF NOT EXISTS offers_by_rooms ON offers (rooms);
+CREATE INDEX IF NOT EXISTS offers_by_location ON offers (city, district);
+CREATE INDEX IF NOT EXISTS offers_by_coordinates ON offers (latitude, longitude);
+CREATE TABLE IF NOT EXISTS attribute_names (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS offer_attributes (
+    offer_id TEXT NOT NULL,
+    kind INTEGER NOT NULL,
+    name_id INTEGER NOT NULL,
+    value,
+    PRIMARY KEY (offer_id, kind, name_id)
+) WITHOUT ROWID;
+"""
+
+
+def _value(value):
+    return None if value == "" else value
+
+
+def _number(value, number_type):
+    try:
+        return number_type(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def get_listing_row(offer):
+    """
+    :param offer: a dict returned by :meth:`gratka.category.get_category`
+    :rtype: dict
+    :return: The offers table columns set by category results
+    """
+    return {
+        'offer_id': str(offer['offer_id']),
+        'detail_url': offer.get('detail_url'),
+        'offer_position': _number(offer.get('offer_position'), int),
+        'offer_points': _number(offer.get('offer_points'), int),
+    }
+
+
+def get_detail_row(offer):
+    """
+    :param offer: a dict returned by :meth:`gratka.offer.get_offer_information`
+    :rtype: dict
+    :return: The offers table columns set by offer details, plus listing columns if the offer has a context
+    """
+    context = offer.get('meta', {}).get('context') or {}
+    offer_id = offer.get('offer_id') or context.get('offer_id')
+    if not offer_id:
+        raise ValueError("Offer has no offer_id")
+    latitude, longitude = offer.get('geographical_coordinates') or (None, None)
+    row = get_listing_row(dict(context, offer_id=offer_id)) if context else {'offer_id': str(offer_id)}
+    row.update({
+        'title': _value(offer.get('title')),
+        'price': _number(offer.get('price'), float),
+        'currency': _value(offer.get('currency')),
+        'additional_rent': _number(offer.get('additional_rent'), float),
+        'surface': _number(offer.get('surface'), float),
+        'rooms': _number(offer.get('rooms'), int),
+        'floor': _number(offer.get('floor'), int),
+        'total_floors': _number(offer.get('total_floors'), int),
+        'city': _value(offer.get('city')),
+        'district': _value(offer.get('district')),
+        'voivodeship': _value(offer.get('voivodeship')),
+        'address': _value(offer.get('address')),
+        'latitude': _number(latitude, float),
+        'longitude': _number(longitude, float),
+        'poster_name': _value(offer.get('poster_name')),
+        'poster_type': _value(offer.get('poster_type')),
+        'company_name': _value(offer.get('company_name')),
+        'phone_numbers': _value(offer.get('phone_numbers')),
+        'description': _value(offer.get('description')),
+        'video_link': _value(offer.get('video_link')),
+        'photo_links': json.dumps(offer.get('photo_links') or []),
+        'offer_details': json.dumps(offer.get('offer_details') or {}, ensure_ascii=False),
+        'is_active': _number(offer.get('meta', {}).get('is_active'), int),
+    })
+    return row
+
+
+class SQLiteSink(object):
+    """
+    Stores category results and offer details in a SQLite database, one row per offer_id. Rows are written in
+    batches of batch_size, each batch in a single transaction. Offers seen again are updated in place, category
+    results never overwrite columns set by offer details.
+
+    apartment_details and additional_assets are kept in the offer_attributes table, with attribute names stored
+    once in attribute_names.
+
+    Upserts need SQLite 3.24 or newer, with older versions every row is inserted or ignored and then updated.
+    """
+
+    def __init__(self, path, batch_size=500):
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self._rows = []
+        self._attributes = []
+        self._name_ids = {}
+        self._load_name_ids()
+        self._statements = {}
+        self.upsert = sqlite3.sqlite_version_info >= UPSERT_SQLITE_VERSION
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _load_name_ids(self):
+        self._name_ids = dict(
+            (name, name_id) for name_id, name in self.connection.execute("SELECT id, name FROM attribute_names")
+        )
+
+    def _get_statements(self, columns):
+        statements = self._statements.get(columns)
+        if statements is None:
+            insert = "INSERT {0}INTO offers ({1}, updated_at) VALUES ({2}, ?)".format(
+                "" if self.upsert else "OR IGNORE ", ", ".join(columns), ", ".join("?" * len(columns))
+            )
+            if self.upsert:
+                statements = (insert + " ON CONFLICT (offer_id) DO UPDATE SET {0}, updated_at = excluded.updated_at"
+                              .format(", ".join("{0} = excluded.{0}".format(column) for column in columns[1:])), None)
+            else:
+                statements = (insert, "UPDATE offers SET {0}, updated_at = ? WHERE offer_id = ?".format(
+                    ", ".join("{0} = ?".format(column) for column in columns[1:])
+                ))
+            self._statements[columns] = statements
+        return statements
+
+    def _write_row(self, row, now):
+        columns = ('offer_id',) + tuple(column for column in COLUMNS if column in row)
+        insert, update = self._get_statements(columns)
+        values = [row[column] for column in columns]
+        if self.connection.execute(insert, values + [now]).rowcount == 0 and update is not None:
+            self.connection.execute(update, values[1:] + [now, row['offer_id']])
+
+    def _get_name_id(self, name):
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            self.connection.execute("INSERT OR IGNORE INTO attribute_names (name) VALUES (?)", (name,))
+            name_id = self.connection.execute("SELECT id FROM attribute_names WHERE name = ?", (name,)).fetchone()[0]
+            self._name_ids[name] = name_id
+        return name_id
+
+    def add_category_results(self, offers):
+        """
+        :param offers: an iterable of dicts returned by :meth:`gratka.category.get_category`
+        """
+        for offer in offers:
+            if offer:
+                self._add(get_listing_row(offer))
+
+    def add_offer(self, offer):
+        """
+        :param offer: a dict returned by :meth:`gratka.offer.get_offer_information`
+        """
+        row = get_detail_row(offer)
+        attributes = [(APARTMENT_DETAILS, name, value)
+                      for name, value in (offer.get('apartment_details') or {}).items()]
+        attributes.extend((ADDITIONAL_ASSETS, name, value)
+                          for name, value in (offer.get('additional_assets') or {}).items())
+        self._attributes.append((row['offer_id'], attributes))
+        self._add(row)
+
+    def add_offers(self, offers):
+        """
+        :param offers: an iterable of dicts returned by :meth:`gratka.offer.get_offer_information`
+        """
+        for offer in offers:
+            self.add_offer(offer)
+
+    def _add(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered rows in a single transaction."""
+        if not self._rows:
+            return
+        now = time.time()
+        try:
+            with self.connection:
+                for row in self._rows:
+                    self._write_row(row, now)
+                for offer_id, attributes in self._attributes:
+                    self.connection.execute("DELETE FROM offer_attributes WHERE offer_id = ?", (offer_id,))
+                    self.connection.executemany(
+                        "INSERT OR REPLACE INTO offer_attributes (offer_id, kind, name_id, value) VALUES (?, ?, ?, ?)",
+                        [(offer_id, kind, self._get_name_id(name), value) for kind, name, value in attributes]
+                    )
+        except Exception:
+            # names added during the rolled back transaction were never written
+            self._load_name_ids()
+            raise
+        log.info("Stored {0} offers in {1}".format(len(self._rows), self.path))
+        self._rows, self._attributes = [], []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def get_attributes(self, offer_id, kind=APARTMENT_DETAILS):
+        """
+        :param offer_id: offer_id of a stored offer
+        :param kind: APARTMENT_DETAILS or ADDITIONAL_ASSETS
+        :rtype: dict
+        """
+        return dict(self.connection.execute(
+            "SELECT attribute_names.name, offer_attributes.value FROM offer_attributes "
+            "JOIN attribute_names ON attribute_names.id = offer_attributes.name_id "
+            "WHERE offer_attributes.offer_id = ? AND offer_attributes.kind = ?", (offer_id, kind)
+        ))
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import math
+import threading
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__file__)
+
+EARTH_RADIUS = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def haversine(latitude, longitude, other_latitude, other_longitude):
+    """
+    :rtype: float
+    :return: The great-circle distance between two points in kilometers
+    """
+    latitude, longitude = math.radians(latitude), math.radians(longitude)
+    other_latitude, other_longitude = math.radians(other_latitude), math.radians(other_longitude)
+    a = (math.sin((other_latitude - latitude) / 2) ** 2 +
+         math.cos(latitude) * math.cos(other_latitude) * math.sin((other_longitude - longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+
+def get_offer_coordinates(offer):
+    """
+    :param offer: a dict returned by :meth:`gratka.offer.get_offer_information`
+    :rtype: tuple(float, float) or None
+    :return: latitude and longitude, None if the offer is not on the map
+    """
+    try:
+        latitude, longitude = offer.get('geographical_coordinates') or (None, None)
+        return float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return None
+
+
+class _Cell(object):
+    __slots__ = ('latitudes', 'longitudes', 'ids')
+
+    def __init__(self):
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.ids = []
+
+    def distances(self, latitude, longitude):
+        """Distances from the point to every item of the cell, vectorized if NumPy is installed."""
+        if numpy is not None and len(self.ids) > 16:
+            latitudes = numpy.radians(numpy.frombuffer(self.latitudes, dtype=numpy.float64))
+            longitudes = numpy.radians(numpy.frombuffer(self.longitudes, dtype=numpy.float64))
+            point_latitude, point_longitude = math.radians(latitude), math.radians(longitude)
+            a = (numpy.sin((latitudes - point_latitude) / 2) ** 2 +
+                 math.cos(point_latitude) * numpy.cos(latitudes) * numpy.sin((longitudes - point_longitude) / 2) ** 2)
+            return (2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1)))).tolist()
+        return [haversine(latitude, longitude, item_latitude, item_longitude)
+                for item_latitude, item_longitude in zip(self.latitudes, self.longitudes)]
+
+
+class SpatialIndex(object):
+    """
+    A grid index over offer coordinates. Points are bucketed into cells of cell_size degrees, so radius, bounding
+    box and nearest neighbour queries only look at the cells around the query point. Items can be inserted, moved
+    and removed at any time.
+
+    ::
+
+        index = SpatialIndex()
+        index.insert_offers(offers)
+        index.radius(54.35, 18.65, 1)  # [(distance in km, offer_id), ...]
+    """
+
+    def __init__(self, cell_size=0.01):
+        self.cell_size = float(cell_size)
+        self._cells = {}
+        self._positions = {}
+        # cell rows and columns ever used, only widened, so nearest() knows when to stop searching
+        self._bounds = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, item_id):
+        return item_id in self._positions
+
+    def _get_cell_key(self, latitude, longitude):
+        return int(math.floor(latitude / self.cell_size)), int(math.floor(longitude / self.cell_size))
+
+    def insert(self, item_id, latitude, longitude):
+        """
+        Adds the item, or moves it if it's already in the index.
+        :param item_id: any hashable, most likely an offer_id
+        """
+        latitude, longitude = float(latitude), float(longitude)
+        with self._lock:
+            if item_id in self._positions:
+                self.remove(item_id)
+            row, column = key = self._get_cell_key(latitude, longitude)
+            if self._bounds is None:
+                self._bounds = [row, row, column, column]
+            else:
+                self._bounds = [min(self._bounds[0], row), max(self._bounds[1], row),
+                                min(self._bounds[2], column), max(self._bounds[3], column)]
+            cell = self._cells.setdefault(key, _Cell())
+            cell.latitudes.append(latitude)
+            cell.longitudes.append(longitude)
+            cell.ids.append(item_id)
+            self._positions[item_id] = (latitude, longitude)
+
+    def insert_offers(self, offers):
+        """
+        :param offers: an iterable of dicts returned by :meth:`gratka.offer.get_offer_information`
+        :rtype: int
+        :return: number of offers inserted, offers without coordinates are skipped
+        """
+        inserted = 0
+        for offer in offers:
+            coordinates = get_offer_coordinates(offer)
+            offer_id = offer.get('offer_id') or (offer.get('meta', {}).get('context') or {}).get('offer_id')
+            if coordinates and offer_id:
+                self.insert(offer_id, *coordinates)
+                inserted += 1
+        return inserted
+
+    def remove(self, item_id):
+        """
+        :rtype: boolean
+        :return: False if the item was not in the index
+        """
+        with self._lock:
+            position = self._positions.pop(item_id, None)
+            if position is None:
+                return False
+            key = self._get_cell_key(*position)
+            cell = self._cells[key]
+            index = cell.ids.index(item_id)
+            # move the last item into the hole, so removal doesn't shift the arrays
+            for values in (cell.latitudes, cell.longitudes, cell.ids):
+                values[index] = values[-1]
+                values.pop()
+            if not cell.ids:
+                del self._cells[key]
+            return True
+
+    def _get_cells(self, south, west, north, east):
+        (min_row, min_column), (max_row, max_column) = self._get_cell_key(south, west), self._get_cell_key(north, east)
+        if (max_row - min_row + 1) * (max_column - min_column + 1) > len(self._cells):
+            return [(key, cell) for key, cell in self._cells.items()
+                    if min_row <= key[0] <= max_row and min_column <= key[1] <= max_column]
+        return [((row, column), self._cells[(row, column)])
+                for row in range(min_row, max_row + 1) for column in range(min_column, max_column + 1)
+                if (row, column) in self._cells]
+
+    def bbox(self, south, west, north, east):
+        """
+        :rtype: list
+        :return: ids of the items inside the bounding box
+        """
+        found = []
+        with self._lock:
+            for _, cell in self._get_cells(south, west, north, east):
+                found.extend(item_id for item_id, latitude, longitude in zip(cell.ids, cell.latitudes, cell.longitudes)
+                             if south <= latitude <= north and west <= longitude <= east)
+        return found
+
+    def radius(self, latitude, longitude, kilometers):
+        """
+        :rtype: list(tuple(float, id))
+        :return: (distance in kilometers, id) of the items within the radius, nearest first
+        """
+        latitude_delta = kilometers / KM_PER_DEGREE
+        longitude_delta = min(180.0, latitude_delta / max(math.cos(math.radians(latitude)), 1e-6))
+        found = []
+        with self._lock:
+            for _, cell in self._get_cells(latitude - latitude_delta, longitude - longitude_delta,
+                                           latitude + latitude_delta, longitude + longitude_delta):
+                found.extend((distance, item_id) for distance, item_id in zip(cell.distances(latitude, longitude),
+                                                                              cell.ids) if distance <= kilometers)
+        found.sort(key=lambda match: match[0])
+        return found
+
+    def nearest(self, latitude, longitude, k=1, max_kilometers=None):
+        """
+        Searches rings of cells around the point until no unvisited cell can hold anything nearer.
+        :rtype: list(tuple(float, id))
+        :return: (distance in kilometers, id) of at most k nearest items, nearest first
+        """
+        with self._lock:
+            if not self._cells:
+                return []
+            center_row, center_column = self._get_cell_key(latitude, longitude)
+            min_row, max_row, min_column, max_column = self._bounds
+            max_ring = max(abs(center_row - min_row), abs(center_row - max_row),
+                           abs(center_column - min_column), abs(center_column - max_column))
+            # the narrowest a cell gets within the searched area, a lower bound for distances between rings
+            cell_kilometers = self.cell_size * KM_PER_DEGREE * max(
+                math.cos(math.radians(min(abs(latitude) + self.cell_size * max_ring, 90))), 1e-6)
+            best = []
+            for ring in range(max_ring + 1):
+                if len(best) == k and -best[0][0] <= (ring - 1) * cell_kilometers:
+                    break
+                if max_kilometers is not None and (ring - 1) * cell_kilometers > max_kilometers:
+                    break
+                for row in range(center_row - ring, center_row + ring + 1):
+                    step = 1 if abs(row - center_row) == ring else 2 * ring or 1
+                    for column in range(center_column - ring, center_column + ring + 1, step):
+                        cell = self._cells.get((row, column))
+                        if cell is None:
+                            continue
+                        for distance, item_id in zip(cell.distances(latitude, longitude), cell.ids):
+                            if max_kilometers is not None and distance > max_kilometers:
+                                continue
+                            if len(best) < k:
+                                heapq.heappush(best, (-distance, item_id))
+                            elif distance < -best[0][0]:
+                                heapq.heapreplace(best, (-distance, item_id))
+        return sorted((-distance, item_id) for distance, item_id in best)
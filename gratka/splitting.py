@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from gratka.category import get_category, get_category_number_of_pages_from_parameters
+
+log = logging.getLogger(__file__)
+
+SPLIT_FILTERS = {
+    'price': ('price_from', 'price_to', 1000),
+    'acreage': ('acreage_from', 'acreage_to', 50),
+}
+
+
+def _with_range(filters, split_on, lower, upper):
+    from_key, to_key, _ = SPLIT_FILTERS[split_on]
+    query = dict(filters)
+    query.pop(from_key, None)
+    query.pop(to_key, None)
+    if lower:
+        query[from_key] = lower
+    if upper is not None:
+        query[to_key] = upper
+    return query
+
+
+def _halve(split_on, lower, upper):
+    """
+    Splits an inclusive range in two touching at their shared bound, so values between two whole numbers, like
+    an acreage of 25.5, are not left out. An open range (upper is None) is split at twice its lower bound.
+    """
+    if upper is None:
+        middle = max(2 * lower, SPLIT_FILTERS[split_on][2])
+        return (lower, middle), (middle, None)
+    middle = (lower + upper) // 2
+    return (lower, middle), (middle, upper)
+
+
+def split_query(region, page_budget=10, split_on='price', max_workers=8, **filters):
+    """
+    This method splits a large search into sub-queries over adjacent price or acreage ranges, so that each of them
+    has at most page_budget pages of results. Neighbouring ranges share their bound, so offers on it are returned
+    by both. Every range is sized with
+    :meth:`gratka.category.get_category_number_of_pages_from_parameters`, ranges of one level are sized concurrently.
+    :param region: see :meth:`gratka.category.get_category` for reference
+    :param page_budget: maximal number of result pages per sub-query
+    :param split_on: 'price' or 'acreage'
+    :param max_workers: number of concurrent sizing requests
+    :param filters: see :meth:`gratka.category.get_category` for reference. Existing range filters bound the split.
+    :rtype: list(dict)
+    :return: A list of filter dicts, each of them ready to be passed to :meth:`gratka.category.get_category`
+    """
+    from_key, to_key, _ = SPLIT_FILTERS[split_on]
+    lower = int(filters.get(from_key) or 0)
+    upper = int(filters[to_key]) if filters.get(to_key) not in (None, "") else None
+    frontier, queries = [(lower, upper)], []
+
+    def size(bounds):
+        return get_category_number_of_pages_from_parameters(region, **_with_range(filters, split_on, *bounds))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while frontier:
+            next_frontier = []
+            for bounds, pages_count in zip(frontier, executor.map(size, frontier)):
+                if not pages_count:
+                    continue
+                if pages_count <= page_budget or (bounds[1] is not None and bounds[1] - bounds[0] <= 1):
+                    if pages_count > page_budget:
+                        log.warning("Range {0} can not be split further, it has {1} pages".format(bounds, pages_count))
+                    queries.append(_with_range(filters, split_on, *bounds))
+                else:
+                    next_frontier.extend(_halve(split_on, *bounds))
+            frontier = next_frontier
+    return queries
+
+
+def get_category_split(region, page_budget=10, split_on='price', max_workers=8, **filters):
+    """
+    Works like :meth:`gratka.category.get_category`, but splits large searches with :meth:`split_query`, scrapes
+    the sub-queries concurrently and drops offers returned by more than one of them.
+    :param region: see :meth:`gratka.category.get_category` for reference
+    :param page_budget: see :meth:`split_query` for reference
+    :param split_on: see :meth:`split_query` for reference
+    :param max_workers: number of sub-queries scraped concurrently
+    :param filters: see :meth:`gratka.category.get_category` for reference
+    :rtype: list(dict)
+    :return: see the return section of :meth:`gratka.category.get_category` for more information
+    """
+    queries = split_query(region, page_budget=page_budget, split_on=split_on, max_workers=max_workers, **filters)
+    log.info("Search split into {0} sub-queries".format(len(queries)))
+
+    seen, parsed_content = set(), []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for offers in executor.map(lambda query: get_category(region, **query), queries):
+            for offer in offers:
+                if not offer or offer['offer_id'] in seen:
+                    continue
+                seen.add(offer['offer_id'])
+                parsed_content.append(offer)
+    return parsed_content
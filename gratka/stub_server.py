@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import logging
+import os
+import pickle
+import random
+import re
+import sys
+import threading
+import time
+
+from gratka.utils import RateLimiter
+
+if sys.version_info < (3, 3):
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+log = logging.getLogger(__file__)
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data")
+
+LISTING_PATTERN = re.compile(r"/lista/(?P<slug>[^,]*),.*?(?P<page>\d+),s\.html$")
+PAGE_COUNT_PATTERN = re.compile(r'(<a class="strona" [^>]*>)\d+(</a>)')
+NO_RESULTS = b'<html><body><div class="brakWynikow">Brak wynik\xc3\xb3w</div></body></html>'
+OFFER_ID_PATTERN = re.compile(r"id_ogl':'(\d+)'")
+MULTIPART_FIELD_PATTERN = re.compile(r'name="([^"]+)"\r\n\r\n([^\r]*)')
+
+
+def load_fixture(data_dir, name):
+    with open(os.path.join(data_dir, name), "rb") as fixture_file:
+        markup = pickle.load(fixture_file)
+    return markup if isinstance(markup, bytes) else markup.encode("utf-8")
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    A local stand-in for Gratka serving the pickled pages from test_data, for end-to-end and load testing.
+    Every search has pages_count listing pages of distinct offers. Detail pages, the /mapper/ endpoint and the
+    region autosuggest are served too.
+
+    Start it with ``python -m gratka.stub_server --port 8000`` and point the library at it with
+    GRATKA_BASE_URL=http://127.0.0.1:8000/ and GRATKA_API_URL=http://127.0.0.1:8000/, or from a test with
+    :meth:`start` and :meth:`gratka.set_base_urls`.
+
+    :param latency: seconds added to every response
+    :param jitter: up to that many seconds are added randomly on top of latency
+    :param error_rate: fraction of requests answered with 503
+    :param max_rate: requests per second above which requests are answered with 429
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, data_dir=DEFAULT_DATA_DIR, pages_count=5, latency=0, jitter=0,
+                 error_rate=0, max_rate=None, seed=None):
+        HTTPServer.__init__(self, (host, port), StubRequestHandler)
+        self.pages_count = pages_count
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle = RateLimiter(max_rate, burst=max(1, int(max_rate))) if max_rate else None
+        self.random = random.Random(seed)
+        self.listing = load_fixture(data_dir, "markup_offers").decode("utf-8")
+        self.offer = load_fixture(data_dir, "offer")
+        self.offer_ids = OFFER_ID_PATTERN.findall(self.listing)
+        self.requests = dict.fromkeys(['listing', 'offer', 'mapper', 'autosuggest', 'errors', 'throttled'], 0)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://{0}:{1}/".format(*self.server_address[:2])
+
+    def count(self, name):
+        with self._lock:
+            self.requests[name] += 1
+
+    def is_throttled(self):
+        return self.throttle is not None and not self.throttle.try_acquire()
+
+    def get_listing_page(self, page):
+        """Every page lists the fixture offers with ids prefixed by the page number, so pages never overlap."""
+        markup = PAGE_COUNT_PATTERN.sub(r"\g<1>{0}\g<2>".format(self.pages_count), self.listing)
+        for offer_id in self.offer_ids:
+            markup = markup.replace(offer_id, "{0}{1}".format(page, offer_id))
+        return markup.encode("utf-8")
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def send_body(self, body, content_type="text/html; charset=utf-8", status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def delay(self):
+        server = self.server
+        seconds = server.latency + (server.random.uniform(0, server.jitter) if server.jitter else 0)
+        if seconds:
+            time.sleep(seconds)
+
+    def fail_if_needed(self):
+        server = self.server
+        if server.is_throttled():
+            server.count('throttled')
+            self.send_body(b"Too Many Requests", "text/plain", 429)
+            return True
+        if server.error_rate and server.random.random() < server.error_rate:
+            server.count('errors')
+            self.send_body(b"Service Unavailable", "text/plain", 503)
+            return True
+        return False
+
+    def do_GET(self):
+        # proxies receive absolute urls, so this server can also stand in for an egress proxy
+        url = urlparse(self.path)
+        path = re.sub(r"/+", "/", url.path)
+        self.delay()
+        if self.fail_if_needed():
+            return
+        server = self.server
+        if path.startswith("/b-dom/ajax/podpowiedzi-lokalizacja"):
+            server.count('autosuggest')
+            text = parse_qs(url.query).get('tekst', [''])[0]
+            suggestion = {'miejscowosc': text.capitalize() or 'Gdańsk', 'id_wojewodztwo': 11}
+            return self.send_body(json.dumps([suggestion]).encode("utf-8"), "application/json")
+        if path.startswith("/tresc/"):
+            server.count('offer')
+            return self.send_body(server.offer)
+        listing = LISTING_PATTERN.search(path)
+        if listing:
+            server.count('listing')
+            page = int(listing.group('page'))
+            if page > server.pages_count:
+                return self.send_body(NO_RESULTS)
+            return self.send_body(server.get_listing_page(page))
+        self.send_body(b"Not Found", "text/plain", 404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8")
+        self.delay()
+        if self.fail_if_needed():
+            return
+        if not urlparse(self.path).path.endswith("/mapper/"):
+            return self.send_body(b"Not Found", "text/plain", 404)
+        self.server.count('mapper')
+        fields = dict(MULTIPART_FIELD_PATTERN.findall(body))
+        slug = fields.get('district') or fields.get('city') or 'polska'
+        redirect_url = "{0}mieszkania/lista/{1}".format(self.server.url, slug)
+        self.send_body(json.dumps({'redirectUrl': redirect_url}).encode("utf-8"), "application/json")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve test_data as a local stand-in for Gratka")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--pages", type=int, default=5, help="number of listing pages of every search")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0, help="random seconds added on top of latency")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests answered with 503")
+    parser.add_argument("--max-rate", type=float, default=None, help="requests per second before answering 429")
+    args = parser.parse_args(argv)
+    server = StubServer(args.host, args.port, args.data_dir, args.pages, args.latency, args.jitter, args.error_rate,
+                        args.max_rate)
+    sys.stderr.write("Serving on {0}, use GRATKA_BASE_URL={0} GRATKA_API_URL={0}\n".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,19 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import functools
 import json
 import logging
+import os
+import threading
+import time
+
+import gratka
 import requests
+from gratka.memo import AUTOSUGGEST, MAPPER, MemoStore, normalize_filters, normalize_region
+from gratka.memory import CACHE, FETCH, profiled, stage
+from gratka.singleflight import StripedCache, coalesce
+from requests.packages.urllib3.util import make_headers
 from scrapper_helpers.utils import caching, key_sha1, normalize_text, get_random_user_agent
 
 try:
@@ -14,14 +24,176 @@ except ImportError:
 
 log = logging.getLogger(__file__)
 
+# gzip and deflate, plus br and zstd when the libraries needed to decode them are installed
+ACCEPT_ENCODING = make_headers(accept_encoding=True)['accept-encoding']
+CHUNK_SIZE = 64 * 1024
+# seconds to connect and to wait for data, so a hung page can't stall a crawl
+TIMEOUT = (10, 60)
+
+RESPONSE_CACHE = None
+RATE_LIMITER = None
+MEMO_STORE = None
+PROXY_POOL = None
+RESILIENCE = None
+# URL mapper results by API URL and filters, concurrent lookups of the same filters make a single request
+MAPPER_CACHE = StripedCache(max_size=4096)
+
+
+class RateLimiter(object):
+    """A thread-safe token bucket allowing rate requests per second on average and burst requests at once."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait(self):
+        """Blocks until a request is allowed."""
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+    def try_acquire(self):
+        """
+        :rtype: boolean
+        :return: True if a request is allowed right now, without waiting
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RequestStats(object):
+    """Thread-safe counters of the requests made by :meth:`gratka.utils.get_response_for_url`."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = {'requests': 0, 'bytes': 0, 'cache_hits': 0}
+
+    def increment(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self.counts[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+REQUEST_STATS = RequestStats()
+
+
+def set_response_cache(cache):
+    """
+    Makes :meth:`gratka.utils.get_response_for_url` store response bodies in the given cache.
+    :param cache: a :class:`gratka.compression.CompressedCache` object or None to disable caching
+    """
+    global RESPONSE_CACHE
+    RESPONSE_CACHE = cache
+
+
+def set_rate_limit(rate, burst=1):
+    """
+    Limits the number of requests made by :meth:`gratka.utils.get_response_for_url`, shared by all threads.
+    :param rate: requests per second or None for no limit
+    :param burst: number of requests that can be made at once after an idle period
+    """
+    global RATE_LIMITER
+    RATE_LIMITER = RateLimiter(rate, burst) if rate else None
+
+
+def set_proxy_pool(pool):
+    """
+    Makes every request of :mod:`gratka.utils` go through the given proxies instead of the direct connection.
+    :param pool: a :class:`gratka.proxies.ProxyPool` object or None to connect directly
+    """
+    global PROXY_POOL
+    PROXY_POOL = pool
+
+
+def send_request(send, url, headers, **kwargs):
+    """
+    Sends a request directly with a random user agent, or through the proxy pool set with
+    :meth:`gratka.utils.set_proxy_pool`.
+    :param send: requests.get, requests.post or a function with the same signature
+    :param url: the url to request
+    :param headers: request headers without the User-Agent
+    :return: a requests.response object
+    """
+    if PROXY_POOL is not None:
+        return PROXY_POOL.send(send, url, headers, **kwargs)
+    return send(url, headers=dict(headers, **{'User-Agent': get_random_user_agent()}), **kwargs)
+
+
+def set_resilience(resilience):
+    """
+    Makes :meth:`gratka.utils.get_response_for_url` retry failed requests, stop requesting failing hosts and hedge
+    slow requests as configured.
+    :param resilience: a :class:`gratka.resilience.Resilience` object or None for a single attempt
+    """
+    global RESILIENCE
+    RESILIENCE = resilience
+
+
+def set_timeout(connect, read):
+    """
+    :param connect: seconds to wait for a connection, None to wait forever
+    :param read: seconds to wait for the next data of a response, None to wait forever
+    """
+    global TIMEOUT
+    TIMEOUT = (connect, read)
+
+
+def get_rate_limit():
+    """
+    :rtype: float or None
+    :return: requests per second set with :meth:`gratka.utils.set_rate_limit`, None for no limit
+    """
+    return RATE_LIMITER.rate if RATE_LIMITER is not None else None
+
+
+def set_memo_store(store):
+    """
+    Makes :meth:`gratka.utils.get_url_from_mapper` and :meth:`gratka.utils.get_region_from_autosuggest` remember
+    their results in the given store, shared by every process using it.
+    :param store: a :class:`gratka.memo.MemoStore` object or None to disable it
+    """
+    global MEMO_STORE
+    MEMO_STORE = store
+
 
 @caching(key_func=key_sha1)
+@coalesce(lambda filters: (gratka.API_URL, normalize_filters(filters)), cache=MAPPER_CACHE)
 def get_url_from_mapper(filters):
     """
     Sends a request to Gratka's URL mapper which returns a valid URL given the supplied key-value pairs
     :param filters: see :meth:`gratka.category.get_category` for reference
     :return: A valid Gratka.pl URL as string
     """
+    # redirect urls of another host, e.g. the stub server, must not be returned
+    memo_store, memo_key = MEMO_STORE, u"{0} {1}".format(gratka.API_URL, normalize_filters(filters))
+    if memo_store is not None:
+        redirect_url = memo_store.get(MAPPER, memo_key)
+        if redirect_url is not None:
+            return redirect_url
+
     paramlist = []
     for k, v in filters.items():
         if isinstance(v, list):
@@ -30,7 +202,7 @@ def get_url_from_mapper(filters):
         else:
             paramlist.append((k, str(v)))
 
-    url = "http://www.gratka.pl/mapper/"
+    url = "{0}mapper/".format(gratka.API_URL)
 
     payload = "\r\n".join([
         "------WebKitFormBoundary7MA4YWxkTrZu0gW\r\nContent-Disposition: form-data; name=\"{0}\"\r\n\r\n{1}"
@@ -41,10 +213,13 @@ def get_url_from_mapper(filters):
     headers = {
         'content-type': "multipart/form-data; boundary=----WebKitFormBoundary7MA4YWxkTrZu0gW",
         'cache-control': "no-cache",
-        'User-Agent': get_random_user_agent()
     }
-    response = requests.request("POST", url, data=payload.encode("utf-8"), headers=headers)
-    return json.loads(response.text)["redirectUrl"]
+    response = send_request(functools.partial(requests.request, "POST"), url, headers, data=payload.encode("utf-8"),
+                            timeout=TIMEOUT)
+    redirect_url = json.loads(response.text)["redirectUrl"]
+    if memo_store is not None:
+        memo_store.set(MAPPER, memo_key, redirect_url)
+    return redirect_url
 
 
 def _float(number, default=None):
@@ -87,7 +262,13 @@ def get_region_from_autosuggest(region_part):
     """
     if not region_part:
         return {}
-    url = u"http://www.gratka.pl/b-dom/ajax/podpowiedzi-lokalizacja/?tekst={0}".format(region_part)
+    memo_store, memo_key = MEMO_STORE, u"{0} {1}".format(gratka.API_URL, normalize_region(region_part))
+    if memo_store is not None:
+        region_dict = memo_store.get(AUTOSUGGEST, memo_key)
+        if region_dict is not None:
+            return region_dict
+
+    url = u"{0}b-dom/ajax/podpowiedzi-lokalizacja/?tekst={1}".format(gratka.API_URL, region_part)
     response = json.loads(get_response_for_url(url).text)[0]
 
     region_dict = {}
@@ -102,6 +283,8 @@ def get_region_from_autosuggest(region_part):
         region_dict["district"] = normalize_text(response["dzielnica"])
     if "id_wojewodztwo" in response:
         region_dict["estate_region"] = response["id_wojewodztwo"]
+    if memo_store is not None:
+        memo_store.set(AUTOSUGGEST, memo_key, region_dict)
     return region_dict
 
 
@@ -142,10 +325,77 @@ def get_url(region, page=1, **filters):
     return url
 
 
+def read_body(response):
+    """
+    Reads the response body in chunks, decoding the transfer compression on the fly.
+    :param response: a requests.response object opened with stream=True
+    :rtype: bytes
+    """
+    response._content = b"".join(response.iter_content(CHUNK_SIZE))
+    response._content_consumed = True
+    return response._content
+
+
+def response_from_body(url, body):
+    """
+    :param url: the url the body was fetched from
+    :param body: bytes, e.g. taken from the response cache
+    :return: a requests.response object
+    """
+    response = requests.models.Response()
+    response.url = url
+    response.status_code = 200
+    response.encoding = 'utf-8'
+    response._content = body
+    response._content_consumed = True
+    return response
+
+
 @caching(key_func=key_sha1)
+@coalesce(lambda url: url)
 def get_response_for_url(url):
     """
+    Concurrent calls for the same url share a single request and response object.
     :param url: an url, most likely from the :meth:`gratka.utils.get_url` method
     :return: a requests.response object
     """
-    return requests.get(url, headers={'User-Agent': get_random_user_agent()})
+    cache_key = key_sha1(url)
+    if RESPONSE_CACHE is not None:
+        with stage(CACHE):
+            body = RESPONSE_CACHE.get(cache_key)
+        if body is not None:
+            REQUEST_STATS.increment(cache_hits=1)
+            return response_from_body(url, body)
+
+    if RESILIENCE is not None:
+        response = RESILIENCE.call(fetch_url, url, before_request=wait_for_rate_limit)
+    else:
+        wait_for_rate_limit()
+        response = fetch_url(url)
+    if RESPONSE_CACHE is not None and response.status_code == 200:
+        with stage(CACHE):
+            RESPONSE_CACHE.set(cache_key, response.content)
+    return response
+
+
+def wait_for_rate_limit():
+    """Waits until the rate set with :meth:`gratka.utils.set_rate_limit` allows another request."""
+    if RATE_LIMITER is not None:
+        RATE_LIMITER.wait()
+
+
+@profiled(FETCH)
+def fetch_url(url):
+    """
+    Makes a single request without the rate limit, the response cache, retries or hedging.
+    :param url: an url, most likely from the :meth:`gratka.utils.get_url` method
+    :return: a requests.response object with the body read
+    """
+    response = send_request(requests.get, url, {'Accept-Encoding': ACCEPT_ENCODING}, stream=True, timeout=TIMEOUT)
+    body = read_body(response)
+    REQUEST_STATS.increment(requests=1, bytes=len(body))
+    return response
+
+
+if os.getenv('GRATKA_MEMO_DB'):
+    set_memo_store(MemoStore(os.getenv('GRATKA_MEMO_DB')))
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='pygratka',
@@ -10,4 +10,9 @@ setup(
     author_email='mail@limebrains.com',
     url='https://github.com/limebrains/pygratka',
     packages=['gratka'],
+    entry_points={
+        'console_scripts': [
+            'gratka = gratka.cli:main',
+        ],
+    },
 )
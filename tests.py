@@ -2,12 +2,41 @@
 # -*- coding: utf-8 -*-
 
 import pytest
+import csv
+import io
+import json
+import os
 import pickle
+import sqlite3
 import sys
+import threading
+import time
+import requests
 from bs4 import BeautifulSoup
 
+import gratka
 import gratka.category as category
+import gratka.changes as changes
+import gratka.cli as cli
+import gratka.compression as compression
+import gratka.crawl_queue as crawl_queue
+import gratka.dedup as dedup
+import gratka.equivalence as equivalence
+import gratka.memo as memo
+import gratka.memory as memory
 import gratka.offer as offer
+import gratka.parse_cache as parse_cache
+import gratka.photos as photos
+import gratka.planning as planning
+import gratka.proxies as proxies
+import gratka.resilience as resilience
+import gratka.scheduling as scheduling
+import gratka.search as search
+import gratka.singleflight as singleflight
+import gratka.sink as sink
+import gratka.spatial as spatial
+import gratka.splitting as splitting
+import gratka.stub_server as stub_server
 import gratka.utils as utils
 
 if sys.version_info < (3, 3):
@@ -56,6 +85,47 @@ def test_get_response_for_url():
     with mock.patch("gratka.utils.requests.get") as get:
         utils.get_response_for_url("")
         assert get.called
+        assert get.call_args[1]['headers']['Accept-Encoding'] == utils.ACCEPT_ENCODING
+
+
+def test_get_response_for_url_cached(tmpdir):
+    cache = compression.CompressedCache(str(tmpdir))
+    cache.set(utils.key_sha1("http://dom.gratka.pl/"), b"<html></html>")
+    utils.set_response_cache(cache)
+    try:
+        with mock.patch("gratka.utils.requests.get") as get:
+            assert utils.get_response_for_url("http://dom.gratka.pl/").content == b"<html></html>"
+            assert not get.called
+    finally:
+        utils.set_response_cache(None)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 3), reason="requires Python3")
+@pytest.mark.parametrize('codec', [compression.CODEC_ZSTD, compression.CODEC_ZLIB, compression.CODEC_RAW])
+def test_compressor_with_dictionary(codec):
+    if codec == compression.CODEC_ZSTD:
+        pytest.importorskip('zstandard')
+    with open("test_data/offer", "rb") as markup_file:
+        markup = pickle.load(markup_file)
+    plain_compressor = compression.Compressor(codec=codec)
+    assert plain_compressor.decompress(plain_compressor.compress(markup)) == markup
+    dictionary = compression.train_dictionary([markup, markup.replace(b"Fundamentowa", b"Grunwaldzka")])
+    compressor = compression.Compressor(dictionary=dictionary, codec=codec)
+    blob = compressor.compress(markup)
+    assert compressor.decompress(blob) == markup
+    if codec != compression.CODEC_RAW:
+        assert len(blob) < len(plain_compressor.compress(markup))
+        with pytest.raises(ValueError):
+            compression.Compressor(dictionary=b"other", codec=codec).decompress(blob)
+
+
+def test_compressed_cache(tmpdir):
+    cache = compression.CompressedCache(str(tmpdir))
+    assert cache.get("missing") is None
+    cache.set("key", b"body")
+    assert "key" in cache
+    assert cache.keys() == ["key"]
+    assert cache.get("key") == b"body"
 
 
 @pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
@@ -101,6 +171,23 @@ def test_was_category_search_successful(markup_path, expected_value):
         assert category.was_category_search_successful(pickle.load(markup_file)) == expected_value
 
 
+@pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
+def test_parse_category_content_listing_details():
+    with open("test_data/markup_offers", "rb") as markup_file:
+        offers = category.parse_category_content(pickle.load(markup_file), listing_details=True)
+    assert offers[0]['price'] == 950.0
+    assert offers[0]['currency'] == "PLN"
+    assert offers[0]['additional_rent'] == 300.0
+    assert offers[0]['surface'] == 25.0
+    assert offers[0]['rooms'] == 1
+    assert (offers[0]['floor'], offers[0]['total_floors']) == (3, 8)
+    assert offers[0]['construction_year'] == 1970
+    assert offers[0]['city'] == u"Gdańsk"
+    assert offers[0]['geographical_coordinates'] == (54.4483, 18.7513)
+    assert 0 in [offer['floor'] for offer in offers]
+    assert all(offer['detail_url'] for offer in offers)
+
+
 def test_get_category():
     with mock.patch("gratka.category.get_url") as get_url,\
             mock.patch("gratka.category.get_response_for_url") as get_response_for_url,\
@@ -262,3 +349,651 @@ def test_get_offer_information(url, context):
             assert get_offer_photos_links.called
             assert get_offer_video_link.called
 
+
+@pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
+def test_equivalence_harness(tmpdir):
+    archive = compression.CompressedCache(str(tmpdir.join("archive")))
+    corpus = equivalence.build_corpus(archive_directories=[archive.directory])
+    archive.set("page", dict(corpus[equivalence.CATEGORY])["markup_offers"])
+    corpus = equivalence.build_corpus(archive_directories=[archive.directory])
+    assert [name for name, _ in corpus[equivalence.OFFER]] == ["offer"]
+    assert "page" in dict(corpus[equivalence.CATEGORY])
+
+    def changed_points(body):
+        offers = category.parse_category_content(body)
+        offers[0]['offer_points'] = 25
+        return offers[:-1]
+
+    def broken(body):
+        raise ValueError("unsupported")
+
+    reports = equivalence.compare(corpus[equivalence.CATEGORY], {
+        'same': category.parse_category_content, 'changed': changed_points, 'broken': broken,
+    }, equivalence.REFERENCES[equivalence.CATEGORY])
+    assert reports['same'].equivalent and reports['same'].speedup > 0
+    assert not reports['changed'].equivalent
+    differences = reports['changed'].differences["markup_offers"]
+    assert differences[0] == ("[0].offer_points", "25", 25)
+    assert differences[-1][0] == "[39]" and differences[-1][2] is equivalence.MISSING
+    assert set(reports['broken'].errors) == set(name for name, _ in corpus[equivalence.CATEGORY])
+    assert equivalence.diff({'geo': (1.0, 2.0)}, {'geo': [1.0, 2.0]}) == []
+    assert equivalence.main(["-k", "offer", "-n", "1", "gratka.offer:parse_offer_information"]) == 0
+
+
+@pytest.mark.skipif(sys.version_info < (3, 4), reason="requires tracemalloc")
+def test_memory_profiler():
+    with open("test_data/markup_offers", "rb") as markup_file:
+        markup = pickle.load(markup_file)
+    with open("test_data/offer", "rb") as markup_file:
+        response = utils.response_from_body("http://dom.gratka.pl/tresc/1.html", pickle.load(markup_file))
+    profiler = memory.MemoryProfiler()
+    profiler.start()
+    memory.set_memory_profiler(profiler)
+    try:
+        for _ in range(3):
+            category.parse_category_content(markup)
+        with mock.patch("gratka.offer.get_response_for_url", return_value=response), \
+                mock.patch("gratka.offer.PARSE_CACHE", parse_cache.ParseCache()):
+            offer.get_offer_information(response.url)
+            offer.get_offer_information(response.url)
+        report = profiler.report()
+    finally:
+        memory.set_memory_profiler(None)
+        profiler.stop()
+    stages = report['stages']
+    assert stages[memory.CATEGORY_PARSE]['calls'] == 3 and stages[memory.OFFER_PARSE]['calls'] == 1
+    assert stages[memory.CACHE]['calls'] == 4
+    # parse trees are released once extraction is done, only a fraction of the parsing peak stays
+    assert stages[memory.OFFER_PARSE]['net_bytes'] < stages[memory.OFFER_PARSE]['peak'] / 4
+    assert stages[memory.CATEGORY_PARSE]['net_bytes'] < stages[memory.CATEGORY_PARSE]['peak'] / 4
+    assert report['peak'] >= stages[memory.CATEGORY_PARSE]['peak']
+
+    html_parser = BeautifulSoup(markup, "html.parser")
+    memory.release_tree(html_parser)
+    assert not html_parser.contents
+
+
+@pytest.mark.skipif(sys.version_info < (3, 1), reason="requires Python3")
+def test_parse_cache(tmpdir):
+    with open("test_data/offer", "rb") as markup_file:
+        response = utils.response_from_body("http://dom.gratka.pl/tresc/1.html", pickle.load(markup_file))
+    disk = compression.CompressedCache(str(tmpdir.join("parsed")))
+    with mock.patch("gratka.offer.get_response_for_url", return_value=response), \
+            mock.patch("gratka.offer.PARSE_CACHE", parse_cache.ParseCache(max_size=16, disk=disk)), \
+            mock.patch("gratka.offer.parse_offer_information", wraps=offer.parse_offer_information) as parse:
+        first = offer.get_offer_information(response.url, context={'offer_id': '1'})
+        first['photo_links'].append('changed.jpg')
+        second = offer.get_offer_information(response.url, context={'offer_id': '2'})
+        assert parse.call_count == 1 and offer.PARSE_CACHE.stats()['memory_hits'] == 1
+        assert second['meta']['context'] == {'offer_id': '2'} and 'changed.jpg' not in second['photo_links']
+        offer.set_parse_cache(parse_cache.ParseCache(disk=disk))
+        assert offer.get_offer_information(response.url)['title'] == first['title'] and parse.call_count == 1
+        assert offer.PARSE_CACHE.stats() == {'memory_hits': 0, 'disk_hits': 1, 'misses': 0}
+        with mock.patch("gratka.offer.EXTRACTOR_VERSION", 2):
+            offer.get_offer_information(response.url)
+        assert parse.call_count == 2
+
+
+def test_crawl_queue_lease_expiry(tmpdir):
+    queue = crawl_queue.CrawlQueue(str(tmpdir.join("queue.db")), shards=2, lease_seconds=0, max_attempts=2)
+    assert queue.enqueue(crawl_queue.TASK_DETAIL, {'url': 'a'}, key='a')
+    assert not queue.enqueue(crawl_queue.TASK_DETAIL, {'url': 'a'}, key='a')
+    first_lease = queue.lease("crashed-worker")
+    second_lease = queue.lease("worker")
+    assert second_lease[0].id == first_lease[0].id and second_lease[0].attempts == 2
+    assert not queue.ack(first_lease[0])
+    assert queue.lease("worker") == []
+    assert queue.stats()[crawl_queue.FAILED] == 1
+
+
+def test_crawl_queue_run_worker(tmpdir):
+    queue = crawl_queue.CrawlQueue(str(tmpdir.join("queue.db")), retry_delay=0)
+    offers = [{'detail_url': 'http://dom.gratka.pl/tresc/1.html', 'offer_id': '1'}]
+    with mock.patch("gratka.crawl_queue.get_category_number_of_pages_from_parameters", return_value=2), \
+            mock.patch("gratka.crawl_queue.get_distinct_category_page", return_value=offers), \
+            mock.patch("gratka.crawl_queue.get_offer_information",
+                       side_effect=[IndexError, {'title': 'offer'}]) as get_offer_information:
+        assert queue.enqueue_category("gda", category_root=100382) == 2
+        assert crawl_queue.run_worker(queue, poll_interval=0) == 3
+        assert get_offer_information.call_count == 2
+    assert queue.is_drained()
+    assert list(queue.results(crawl_queue.TASK_DETAIL)) == [{'title': 'offer'}]
+
+
+def test_split_query():
+    prices = list(range(0, 3000, 10))
+
+    def number_of_pages(region, **filters):
+        upper = filters.get('price_to', float('inf'))
+        return -(-len([p for p in prices if filters.get('price_from', 0) <= p <= upper]) // 20)
+
+    with mock.patch("gratka.splitting.get_category_number_of_pages_from_parameters", side_effect=number_of_pages):
+        queries = splitting.split_query("gda", page_budget=3, category_root=100382)
+    assert all(number_of_pages("gda", **query) <= 3 for query in queries)
+    assert all(query['category_root'] == 100382 for query in queries)
+    assert all(any(q.get('price_from', 0) <= p <= q.get('price_to', float('inf')) for q in queries) for p in prices)
+
+
+def test_split_query_fractional_values():
+    acreages = [25.5, 26, 37.25, 49.9, 50.5, 99.5, 150, 251.75] * 10
+
+    def number_of_pages(region, **filters):
+        upper = filters.get('acreage_to', float('inf'))
+        return -(-len([a for a in acreages if filters.get('acreage_from', 0) <= a <= upper]) // 5)
+
+    with mock.patch("gratka.splitting.get_category_number_of_pages_from_parameters", side_effect=number_of_pages):
+        queries = splitting.split_query("gda", page_budget=2, split_on='acreage')
+    assert len(queries) > 1
+    for acreage in acreages:
+        assert any(q.get('acreage_from', 0) <= acreage <= q.get('acreage_to', float('inf')) for q in queries)
+
+
+def test_get_category_split():
+    with mock.patch("gratka.splitting.split_query", return_value=[{'price_to': 10}, {'price_from': 11}]), \
+            mock.patch("gratka.splitting.get_category", side_effect=[
+                [{'offer_id': '1'}, {'offer_id': '2'}], [{'offer_id': '2'}, {'offer_id': '3'}]
+            ]):
+        assert [o['offer_id'] for o in splitting.get_category_split("gda", max_workers=1)] == ['1', '2', '3']
+
+
+def test_offer_index_persistence(tmpdir):
+    path = str(tmpdir.join("offers.idx"))
+    index = dedup.OfferIndex(path)
+    assert index.add("64064026")
+    assert not index.add("64064026")
+    index.close()
+    reopened = dedup.OfferIndex(path)
+    assert "64064026" in reopened and "73379581" not in reopened
+    assert len(reopened) == 1
+
+
+def test_bloom_filter():
+    bloom = dedup.BloomFilter(1000, error_rate=0.01)
+    assert all(bloom.add(offer_id) for offer_id in range(1000))
+    assert all(offer_id in bloom for offer_id in range(1000))
+    assert len([offer_id for offer_id in range(1000, 3000) if offer_id in bloom]) < 100
+
+
+@pytest.mark.parametrize('index', [None, dedup.BloomFilter(100)])
+def test_offer_deduplicator(index):
+    deduplicator = dedup.OfferDeduplicator(index)
+    offers = [{'offer_id': '1', 'detail_url': 'a'}, {'offer_id': '2', 'detail_url': 'b'}, {'offer_id': '1'}]
+    with mock.patch("gratka.dedup.get_offer_information") as get_offer_information:
+        assert len(list(deduplicator.get_offers_information(offers))) == 2
+        assert get_offer_information.call_count == 2
+    assert deduplicator.stats() == {'seen': 3, 'new': 2, 'avoided_fetches': 1}
+
+
+def test_offer_deduplicator_threads():
+    deduplicator = dedup.OfferDeduplicator()
+    offers = [{'offer_id': str(i % 500)} for i in range(2000)]
+    threads = [threading.Thread(target=lambda: [deduplicator.is_new(offer) for offer in offers]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert deduplicator.stats() == {'seen': 8000, 'new': 500, 'avoided_fetches': 7500}
+
+
+def test_download_offer_photos(tmpdir):
+    bodies = {'http://img/1.jpg': [b"same", b" photo"], 'http://img/2.JPG': [b"same photo"], 'http://img/3': [b"x"]}
+
+    def get(url, **kwargs):
+        response = mock.Mock()
+        response.iter_content.return_value = iter(bodies[url])
+        return response
+
+    offers = [{'photo_links': ['http://img/1.jpg', 'http://img/2.JPG']}, {'photo_links': ['http://img/3', '']}]
+    with mock.patch("gratka.photos.requests.get", side_effect=get) as requests_get:
+        downloader = photos.PhotoDownloader(str(tmpdir), max_workers=2)
+        paths = downloader.download_offers(offers)
+        assert len(paths) == 3 and len(set(paths.values())) == 2
+        assert sorted(tmpdir.listdir()) == sorted(tmpdir.join(name) for name in [
+            photos.MANIFEST_NAME, paths['http://img/1.jpg'].split("/")[-1], paths['http://img/3'].split("/")[-1]
+        ])
+        assert downloader.stats['downloaded'] == 2 and downloader.stats['duplicates'] == 1
+        assert photos.download_offer_photos(offers, str(tmpdir)) == paths
+        assert requests_get.call_count == 3
+
+
+def test_download_offer_photos_failures(tmpdir):
+    responses = []
+
+    def get(url, **kwargs):
+        if url.endswith("refused"):
+            raise requests.ConnectionError("refused")
+        response = mock.Mock()
+        responses.append(response)
+        if url.endswith("missing"):
+            response.raise_for_status.side_effect = requests.HTTPError("404")
+        else:
+            response.iter_content.side_effect = requests.ConnectionError("reset")
+        return response
+
+    downloader = photos.PhotoDownloader(str(tmpdir))
+    descriptors = len(os.listdir("/proc/self/fd")) if os.path.isdir("/proc/self/fd") else None
+    with mock.patch("gratka.photos.requests.get", side_effect=get):
+        for i in range(20):
+            for failure in ("refused", "missing", "reset"):
+                assert downloader.download("http://img/{0}/{1}".format(i, failure)) is None
+    assert downloader.stats['failed'] == 60
+    assert len(responses) == 40 and all(response.close.called for response in responses)
+    assert tmpdir.listdir() == []
+    if descriptors is not None:
+        assert len(os.listdir("/proc/self/fd")) == descriptors
+
+
+def test_rate_limiter():
+    limiter = utils.RateLimiter(rate=100)
+    started = time.time()
+    for _ in range(6):
+        limiter.wait()
+    assert time.time() - started >= 0.05
+
+
+def test_cli_parse_filters():
+    assert cli.parse_filters(["category_changer=100401", "keyword=balkon", "garage[]=1", "media[]=2", "media[]=4"]) == {
+        'category_changer': 100401, 'keyword': 'balkon', 'garage[]': [1], 'media[]': [2, 4]
+    }
+
+
+@pytest.mark.parametrize('details', [False, True])
+def test_cli_crawl(details):
+    pages = {1: [{'offer_id': '1', 'detail_url': 'a'}, {'offer_id': '2', 'detail_url': 'b'}],
+             2: [{'offer_id': '2', 'detail_url': 'b'}, {'offer_id': '3', 'detail_url': 'c'}]}
+    output = io.StringIO()
+    with mock.patch("gratka.cli.plan_crawl", return_value=planning.CrawlPlan("gda", {}, 2, pages[1])), \
+            mock.patch("gratka.cli.get_distinct_category_page", side_effect=lambda page, region, **f: pages[page]), \
+            mock.patch("gratka.cli.get_offer_information",
+                       side_effect=lambda url, context: {'title': url}) as get_offer_information:
+        assert cli.crawl("gda", {}, cli.JsonLinesWriter(output), details=details, workers=1) == 3
+        assert get_offer_information.call_count == (3 if details else 0)
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    key = 'title' if details else 'detail_url'
+    assert sorted(record[key] for record in records) == ['a', 'b', 'c']
+
+
+def test_cli_csv_writer(tmpdir):
+    path = str(tmpdir.join("offers.csv"))
+    with io.open(path, "w", encoding="utf-8", newline="") as output:
+        writer = cli.CsvWriter(output)
+        writer.write({'offer_id': '1', 'title': u"Gdańsk", 'geographical_coordinates': (54.4, 18.7)})
+        with io.open(path, encoding="utf-8", newline="") as partial:
+            assert len(list(csv.DictReader(partial))) == 1
+        writer.write({'offer_id': '2', 'price': 950.0, 'apartment_details': {u'Piętro': '2'}})
+        writer.close()
+    with io.open(path, encoding="utf-8", newline="") as output:
+        rows = list(csv.DictReader(output))
+    assert rows[0] == {'offer_id': '1', 'title': u"Gdańsk", 'geographical_coordinates': '[54.4, 18.7]',
+                       cli.CSV_EXTRA_COLUMN: ''}
+    assert rows[1]['title'] == '' and rows[1]['geographical_coordinates'] == ''
+    assert json.loads(rows[1][cli.CSV_EXTRA_COLUMN]) == {'price': 950.0, 'apartment_details': {u'Piętro': '2'}}
+
+
+def test_detail_scheduler():
+    offers = [{'offer_id': '10', 'offer_points': '0', 'offer_position': '1'},
+              {'offer_id': '30', 'offer_points': '25', 'offer_position': '2'},
+              {'offer_id': '20', 'offer_points': '25', 'offer_position': '3'}]
+    seen = dedup.OfferIndex()
+    seen.add('30')
+    scheduler = scheduling.DetailScheduler(scheduling.get_priority(['unseen', 'recency'], seen), max_fetches=2,
+                                           seen=seen)
+    scheduler.push_many(offers)
+    assert [scheduler.pop()['offer_id'] for _ in range(2)] == ['20', '10']
+    assert scheduler.pop() is None and scheduler.stats() == {'taken': 2, 'queued': 0, 'dropped': 1}
+    scheduler.done({'offer_id': '20'})
+    assert '20' in seen
+    scheduler = scheduling.DetailScheduler(scheduling.get_priority(['points', 'position']))
+    scheduler.push_many(offers)
+    assert [scheduler.pop()['offer_id'] for _ in range(3)] == ['30', '20', '10']
+    with pytest.raises(ValueError):
+        scheduling.get_priority(['unseen'])
+
+    pages = {1: [{'offer_id': '1', 'detail_url': 'a'}, {'offer_id': '2', 'detail_url': 'b'}],
+             2: [{'offer_id': '3', 'detail_url': 'c'}]}
+    output = io.StringIO()
+    scheduler = scheduling.DetailScheduler(scheduling.by_recency, max_fetches=2)
+    popped, pop = threading.Event(), scheduler.pop
+
+    def get_page(page, region, **filters):
+        # the first page comes with the plan, the second one arrives after the first detail is taken
+        popped.wait(5)
+        return pages[page]
+
+    def pop_and_signal():
+        offer = pop()
+        popped.set()
+        return offer
+
+    scheduler.pop = pop_and_signal
+    with mock.patch("gratka.cli.plan_crawl", return_value=planning.CrawlPlan("gda", {}, 2, pages[1])), \
+            mock.patch("gratka.cli.get_distinct_category_page", side_effect=get_page), \
+            mock.patch("gratka.cli.get_offer_information", side_effect=lambda url, context: {'title': url}):
+        progress = cli.Progress(details=True)
+        assert cli.crawl("gda", {}, cli.JsonLinesWriter(output), details=True, workers=1, progress=progress,
+                         scheduler=scheduler) == 2
+    assert [json.loads(line)['title'] for line in output.getvalue().splitlines()] == ['b', 'c']
+    assert progress.dropped_offers == 1
+
+
+@pytest.fixture
+def stub():
+    base_url, api_url = gratka.BASE_URL, gratka.API_URL
+    with stub_server.StubServer(pages_count=2) as server:
+        gratka.set_base_urls(server.url, server.url)
+        yield server
+    gratka.set_base_urls(base_url, api_url)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 3), reason="requires Python3")
+def test_stub_server_end_to_end(stub):
+    offers = category.get_category("gda", category_root=100382, category_changer=100401)
+    assert len(offers) == 80 and len(set(o['offer_id'] for o in offers)) == 80
+    assert offers[0]['detail_url'].startswith(stub.url)
+    assert offer.get_offer_information(offers[0]['detail_url'], context=offers[0])['price'] == 25.0
+    assert stub.requests['listing'] == 2 and stub.requests['offer'] == 1
+
+
+def test_set_base_urls_whitelist():
+    base_url, api_url = gratka.BASE_URL, gratka.API_URL
+    try:
+        gratka.set_base_urls("http://127.0.0.1:8000", "http://127.0.0.1:8000")
+        assert gratka.WHITELISTED_DOMAINS == gratka.DEFAULT_WHITELISTED_DOMAINS + ['127.0.0.1']
+    finally:
+        gratka.set_base_urls(base_url, api_url)
+    assert '127.0.0.1' not in gratka.WHITELISTED_DOMAINS
+    assert gratka.WHITELISTED_DOMAINS == gratka.DEFAULT_WHITELISTED_DOMAINS
+
+
+def test_crawl_plan_detail_failure():
+    offers = [{'offer_id': str(i), 'detail_url': str(i)} for i in range(4)]
+    plan = planning.CrawlPlan("gda", {}, 1, offers, details=True, workers=2)
+
+    def get_offer_information(url, context=None):
+        if url == '2':
+            raise IndexError("list index out of range")
+        return {'title': url}
+
+    with mock.patch("gratka.planning.get_offer_information", side_effect=get_offer_information):
+        assert [offer['title'] for offer in plan.execute()] == ['0', '1', '3']
+
+
+@pytest.mark.skipif(sys.version_info < (3, 3), reason="requires Python3")
+def test_crawl_plan(stub):
+    plan = planning.plan_crawl("gda", details=True, rate=10, workers=2, category_root=100382, category_changer=100401)
+    assert plan.pages_count == 2 and plan.estimated_offers == 80 and plan.estimated_requests == 81
+    assert plan.estimated_bytes == plan.first_page_bytes + 80 * planning.AVERAGE_DETAIL_BYTES
+    assert plan.estimated_seconds >= 8.1 and plan.to_dict()['filters'] == {'category_root': 100382,
+                                                                           'category_changer': 100401}
+    plan.details = False
+    assert len(plan.execute()) == 80 and stub.requests['listing'] == 2
+    output = io.StringIO()
+    assert cli.crawl("gda", plan.filters, cli.JsonLinesWriter(output), workers=2, progress=cli.Progress()) == 80
+    assert stub.requests['listing'] == 4
+
+
+def test_proxy_pool(stub):
+    target = "http://dom.gratka.test/tresc/1.html"
+    with stub_server.StubServer(latency=0.2) as slow_proxy:
+        pool = proxies.ProxyPool([stub.url, slow_proxy.url])
+        with mock.patch("gratka.utils.PROXY_POOL", pool):
+            assert [utils.get_response_for_url(target).status_code for _ in range(4)] == [200] * 4
+            assert stub.requests['offer'] == 2 and slow_proxy.requests['offer'] == 2
+            pool.strategy = proxies.LEAST_LATENCY
+            utils.get_response_for_url(target)
+            assert stub.requests['offer'] == 3
+            stub.throttle = utils.RateLimiter(0.001)
+            assert [utils.get_response_for_url(target).status_code for _ in range(3)] == [200, 429, 200]
+    fast, slow = pool.stats()
+    assert fast['throttled'] == 1 and fast['cooling_down'] and not slow['cooling_down']
+    assert slow['requests'] == 3 and slow['latency'] > fast['latency']
+
+    sent = []
+
+    def send(url, headers, proxies):
+        sent.append((str(proxies), headers['User-Agent']))
+        return mock.Mock(status_code=200)
+
+    pool = proxies.ProxyPool([None, "http://127.0.0.1:3128"])
+    for _ in range(4):
+        pool.send(send, target, {})
+    assert len(sent) == 4 and len(set(sent)) == 2 and len(set(proxy for proxy, _ in sent)) == 2
+
+
+def test_stub_server_failures(stub):
+    stub.error_rate = 1
+    assert utils.get_response_for_url(stub.url + "tresc/1.html").status_code == 503
+    stub.error_rate, stub.throttle = 0, utils.RateLimiter(0.001)
+    statuses = [utils.get_response_for_url(stub.url + "tresc/1.html").status_code for _ in range(2)]
+    assert statuses == [200, 429]
+
+
+def test_memo_store_warm_up(stub, tmpdir):
+    path = str(tmpdir.join("memo.db"))
+    assert memo.normalize_filters({'b': [2, '1'], 'a': 1}) == memo.normalize_filters({'a': '1', 'b': ['1', 2]})
+    filters_list = [{'category_changer': 100401}, {'category_changer': 100403}]
+    with mock.patch("gratka.utils.MEMO_STORE", memo.MemoStore(path)):
+        assert memo.warm_up(["gda", "Gda "], filters_list, max_workers=1) == {'resolved': 4, 'failed': 0}
+    assert stub.requests['autosuggest'] == 1 and stub.requests['mapper'] == 2
+    with mock.patch("gratka.utils.MEMO_STORE", memo.MemoStore(path)):
+        url = utils.get_url("GDA", category_changer=100401)
+    assert url.startswith(stub.url) and stub.requests['autosuggest'] == 1 and stub.requests['mapper'] == 2
+    with mock.patch("gratka.utils.MEMO_STORE", memo.MemoStore(path)), \
+            mock.patch("gratka.API_URL", "http://127.0.0.1:1/"), pytest.raises(requests.ConnectionError):
+        utils.get_url_from_mapper({'category_changer': 100401})
+
+
+def test_single_flight():
+    calls = []
+    started = threading.Event()
+
+    def fetch(key):
+        calls.append(key)
+        started.set()
+        time.sleep(0.2)
+        if key == 'broken':
+            raise ValueError(key)
+        return key.upper()
+
+    cache = singleflight.StripedCache(stripes=2, max_size=2)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_set('a', fetch, 'a'))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+        started.wait()
+    for thread in threads:
+        thread.join()
+    assert results == ['A'] * 5 and calls == ['a'] and cache._flight.coalesced == 4
+
+    flight, errors = singleflight.SingleFlight(), []
+
+    def call_broken():
+        try:
+            flight.do('broken', fetch, 'broken')
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call_broken) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3 and calls.count('broken') == 1
+
+    for key in range(10):
+        cache.set(key, key)
+    assert len(cache) <= 2 and 'a' not in cache
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="requires asyncio")
+def test_async_single_flight():
+    import asyncio
+    flight, calls = singleflight.AsyncSingleFlight(), []
+
+    def fetch(key):
+        calls.append(key)
+        return asyncio.sleep(0.05, result=key.upper())
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(asyncio.gather(*[flight.do('a', fetch, 'a') for _ in range(3)]))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    assert results == ['A'] * 3 and calls == ['a'] and flight.coalesced == 2
+
+
+def test_resilience_retries_and_circuit_breaker(stub):
+    url = stub.url + "tresc/1.html"
+    breaker = resilience.CircuitBreaker(failure_threshold=3, reset_timeout=0.2)
+    policy = resilience.Resilience(resilience.RetryPolicy(attempts=2, backoff=0.01), breaker)
+    stub.error_rate = 1
+    with mock.patch("gratka.utils.RESILIENCE", policy):
+        assert utils.get_response_for_url(url).status_code == 503
+        for _ in range(2):
+            # the third failure opens the circuit before the second call can retry
+            with pytest.raises(resilience.CircuitOpenError):
+                utils.get_response_for_url(url)
+        assert stub.requests['errors'] == 3 and breaker.state(stub.url[7:-1]) == resilience.OPEN
+        stub.error_rate = 0
+        time.sleep(0.2)
+        assert utils.get_response_for_url(url).status_code == 200
+    assert breaker.state(stub.url[7:-1]) == resilience.CLOSED
+    assert policy.stats() == {'retries': 2, 'hedges': 0, 'hedge_wins': 0, 'rejected': 2}
+    stub.latency = 0.5
+    with mock.patch("gratka.utils.TIMEOUT", (1, 0.1)), pytest.raises(IOError):
+        utils.get_response_for_url(url)
+
+
+def test_resilience_hedging():
+    latencies = resilience.LatencyTracker(min_samples=1)
+    latencies.add(0.05)
+    policy = resilience.Resilience(hedge_percentile=0.9, latencies=latencies)
+    delays = [1, 0]
+
+    def fetch(url):
+        time.sleep(delays.pop(0))
+        return mock.Mock(status_code=200, url=url)
+
+    started = time.time()
+    assert policy.call(fetch, "http://dom.gratka.pl/tresc/1.html").status_code == 200
+    assert time.time() - started < 0.5 and policy.stats()['hedge_wins'] == 1
+
+
+def test_resilience_rate_limit_and_half_open_circuit():
+    latencies = resilience.LatencyTracker(min_samples=1)
+    latencies.add(0.05)
+    policy = resilience.Resilience(hedge_percentile=0.9, latencies=latencies)
+    fetch = mock.Mock(return_value=mock.Mock(status_code=200))
+    # time spent waiting for the rate limit neither triggers a hedge nor counts as latency
+    policy.call(fetch, "http://dom.gratka.pl/tresc/1.html", before_request=lambda: time.sleep(0.2))
+    assert fetch.call_count == 1 and policy.stats()['hedges'] == 0 and latencies.percentile(1) < 0.1
+
+    breaker = resilience.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    policy = resilience.Resilience(breaker=breaker)
+    with pytest.raises(IOError):
+        policy.call(mock.Mock(side_effect=IOError("refused")), "http://dom.gratka.pl/tresc/1.html")
+    with pytest.raises(ValueError):
+        policy.call(mock.Mock(side_effect=ValueError("unparsable")), "http://dom.gratka.pl/tresc/1.html")
+    assert breaker.state("dom.gratka.pl") == resilience.OPEN
+    assert policy.call(fetch, "http://dom.gratka.pl/tresc/1.html").status_code == 200
+    assert breaker.state("dom.gratka.pl") == resilience.CLOSED
+
+
+def test_change_feed(tmpdir):
+    def get_offer(offer_id, price=1000.0, is_active='1', views='1'):
+        return {'offer_id': offer_id, 'price': price, 'additional_rent': 300.0, 'description': 'Mieszkanie  w bloku',
+                'photo_links': ['a.jpg'], 'offer_details': {'Liczba odsłon: ': views}, 'meta': {'is_active': is_active}}
+
+    feed = changes.ChangeFeed(str(tmpdir.join("changes.db")))
+    assert [e['type'] for e in feed.diff([get_offer('1'), get_offer('2'), get_offer('3')])] == ['new'] * 3
+    events = list(feed.diff([get_offer('1', views='2'), get_offer('2', price=900.0), get_offer('3', is_active='0')]))
+    assert events == [
+        {'type': 'changed', 'offer_id': '2', 'changes': {'price': {'old': 1000.0, 'new': 900.0}}},
+        {'type': 'deactivated', 'offer_id': '3'},
+    ]
+    assert list(feed.diff([get_offer('2', price=900.0), get_offer('3', is_active='0')])) == [
+        {'type': 'removed', 'offer_id': '1'}
+    ]
+    assert list(feed.diff([get_offer('1')], complete=False)) == [{'type': 'reactivated', 'offer_id': '1'}]
+    assert changes.get_offer_fingerprint(get_offer('1')) == changes.get_offer_fingerprint(get_offer('1', views='9'))
+
+
+@pytest.mark.parametrize('upsert', [True, False])
+def test_sqlite_sink(tmpdir, upsert):
+    path = str(tmpdir.join("offers.db"))
+    offer_information = {
+        'offer_id': '64064026', 'title': 'Mieszkanie', 'price': 950.0, 'surface': 25.0, 'rooms': 1, 'city': 'Gdańsk',
+        'district': '', 'geographical_coordinates': (54.35, 18.49), 'photo_links': ['a.jpg'],
+        'apartment_details': {'Kuchnia': 'oddzielna'}, 'additional_assets': {'balcony': True},
+        'meta': {'is_active': '1', 'context': None}
+    }
+    with sink.SQLiteSink(path, batch_size=2) as offers_sink:
+        offers_sink.upsert = upsert and offers_sink.upsert
+        offers_sink.add_category_results([{'offer_id': '64064026', 'detail_url': 'a', 'offer_position': '1',
+                                           'offer_points': '25'}, {'offer_id': '2', 'detail_url': 'b'}])
+        offers_sink.add_offer(offer_information)
+        offers_sink.add_category_results([{'offer_id': '64064026', 'detail_url': 'c', 'offer_position': '3'}])
+        offers_sink.flush()
+        assert offers_sink.get_attributes('64064026') == {'Kuchnia': 'oddzielna'}
+        assert offers_sink.get_attributes('64064026', sink.ADDITIONAL_ASSETS) == {'balcony': 1}
+    connection = sqlite3.connect(path)
+    assert [column[1] for column in connection.execute("PRAGMA table_info(offers)")] == (
+        ['offer_id'] + list(sink.COLUMNS) + ['updated_at']
+    )
+    assert set(sink.get_detail_row(offer_information)) == set(name for name, _ in sink.DETAIL_COLUMNS) | {'offer_id'}
+    assert connection.execute("SELECT offer_id, detail_url, offer_position, price, district, latitude, is_active "
+                              "FROM offers ORDER BY offer_id").fetchall() == [
+        ('2', 'b', None, None, None, None, None), ('64064026', 'c', 3, 950.0, None, 54.35, 1)
+    ]
+
+
+def test_sqlite_sink_rollback(tmpdir):
+    offers_sink = sink.SQLiteSink(str(tmpdir.join("offers.db")))
+    offers_sink.add_offer({'offer_id': '1', 'apartment_details': {'Kuchnia': {'unsupported': 'value'}}})
+    with pytest.raises(sqlite3.Error):
+        offers_sink.flush()
+    assert offers_sink._name_ids == {}
+    offers_sink._rows, offers_sink._attributes = [], []
+    offers_sink.add_offer({'offer_id': '2', 'apartment_details': {'Kuchnia': 'oddzielna'}})
+    offers_sink.flush()
+    assert offers_sink.get_attributes('2') == {'Kuchnia': 'oddzielna'}
+
+
+def test_spatial_index():
+    index = spatial.SpatialIndex(cell_size=0.01)
+    assert index.insert_offers([
+        {'offer_id': 'oliwa', 'geographical_coordinates': (54.4105, 18.5582)},
+        {'offer_id': 'wrzeszcz', 'geographical_coordinates': (54.3806, 18.6067)},
+        {'offer_id': 'sopot', 'geographical_coordinates': (54.4418, 18.5601)},
+        {'offer_id': 'nowhere', 'geographical_coordinates': ("", "")},
+    ]) == 3
+    assert [item for _, item in index.radius(54.4105, 18.5600, 5)] == ['oliwa', 'sopot', 'wrzeszcz']
+    assert sorted(index.bbox(54.40, 18.55, 54.45, 18.57)) == ['oliwa', 'sopot']
+    assert [item for _, item in index.nearest(54.3800, 18.6000, k=2)] == ['wrzeszcz', 'oliwa']
+    assert index.nearest(54.3800, 18.6000, max_kilometers=0.1) == []
+    index.insert('wrzeszcz', 54.4420, 18.5600)
+    assert index.remove('sopot') and not index.remove('sopot')
+    assert [item for _, item in index.nearest(54.4418, 18.5601)] == ['wrzeszcz']
+    assert len(index) == 2
+
+
+def test_inverted_index(tmpdir):
+    index = search.InvertedIndex()
+    index.add_offers([
+        {'offer_id': '1', 'title': 'Mieszkanie Gdańsk', 'description': 'Słoneczne, z balkonem i windą'},
+        {'offer_id': '2', 'title': 'Kawalerka Sopot', 'description': 'Taras, parter, WINDA'},
+        {'offer_id': '3', 'title': 'Dom Gdynia', 'description': 'Ogród i taras'},
+    ])
+    assert index.search("gdansk") == ['1']
+    assert index.search("balkon*, taras -parter") == ['1', '3']
+    assert index.search("taras winda") == ['2']
+    assert index.search("sloneczne") == index.search("Słoneczne") == ['1']
+    index.add_offer({'offer_id': '3', 'title': 'Dom Gdynia', 'description': 'Ogród'})
+    assert index.search("taras") == ['2']
+    path = str(tmpdir.join("index.json.gz"))
+    index.save(path)
+    loaded = search.InvertedIndex.load(path)
+    assert loaded.remove('2')
+    assert loaded.search("taras, ogrod") == ['3'] and len(loaded) == 2